@@ -0,0 +1,33 @@
+import json
+
+import click
+
+
+def flatten(result, prefix=''):
+    for key, value in result.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f'{prefix}{key}.')
+        elif isinstance(value, (int, float)):
+            yield f'{prefix}{key}', value
+
+
+@click.command()
+@click.argument('before', type=click.File())
+@click.argument('after', type=click.File())
+def main(before, after):
+    """
+    compare two benchmark.suite json reports metric by metric: python -m benchmark.compare before.json after.json
+    """
+    before, after = json.load(before), json.load(after)
+    click.echo(f'{before["commit"]} -> {after["commit"]}')
+    for workload, result in after['results'].items():
+        old = dict(flatten(before['results'].get(workload, {})))
+        for metric, value in flatten(result):
+            if metric not in old:
+                continue
+            change = f'{(value - old[metric]) / old[metric] * 100:+.1f}%' if old[metric] else ''
+            click.echo(f'{workload + "." + metric:<40}{old[metric]:>14}{value:>14}{change:>10}')
+
+
+if __name__ == '__main__':
+    main()
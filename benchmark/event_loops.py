@@ -0,0 +1,40 @@
+import asyncio
+
+import click
+
+from utils.event_loop import EVENT_LOOPS
+from benchmark.harness import Deployment
+from benchmark.workloads import setup, bulk, MB
+
+
+async def bench_loop(event_loop: str, connections: int, streams: int, size: int, settings):
+    deployment = Deployment(event_loop=event_loop, **settings)
+    await deployment.start()
+    try:
+        return {**await setup(deployment, connections), **await bulk(deployment, streams, size)}
+    finally:
+        await deployment.stop()
+
+
+@click.command()
+@click.option('--loop', 'loops', multiple=True, type=click.Choice(EVENT_LOOPS[1:]), default=EVENT_LOOPS[1:],
+              help='event loops to compare, server and client run on it')
+@click.option('--connections', default=500, help='sequential tunnels for the setup latency')
+@click.option('--streams', default=8, help='concurrent transfers for the throughput')
+@click.option('--size', default=64, help='MB per transfer')
+@click.option('--multiplex', is_flag=True, help='multiplexed relays')
+def main(loops, connections, streams, size, multiplex):
+    """
+    compare tunnel setup latency and throughput of the server and client under each event loop,
+    the load generator and the targets run in this process on the asyncio loop: python -m benchmark.event_loops
+    """
+    settings = {'relay_multiplex': multiplex}
+    click.echo(f'{"loop":<10}{"setup p50 ms":>14}{"setup p99 ms":>14}{"down MB/s":>12}{"up MB/s":>10}')
+    for event_loop in loops:
+        result = asyncio.run(bench_loop(event_loop, connections, streams, size * MB, settings))
+        click.echo(f'{event_loop:<10}{result["setup_p50_ms"]:>14}{result["setup_p99_ms"]:>14}'
+                   f'{result["download_mb_per_s"]:>12}{result["upload_mb_per_s"]:>10}')
+
+
+if __name__ == '__main__':
+    main()
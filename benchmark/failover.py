@@ -0,0 +1,99 @@
+import time
+import asyncio
+from typing import Dict, Any
+
+import click
+
+from benchmark.harness import Deployment, SIZE, CHUNK, counted
+from benchmark.workloads import MB
+
+# relay modes whose tunnels must survive the client's manager connection being cut
+CASES = {
+    'dedicated': {'relay_reuse': False},
+    'reused': {'relay_reuse': True},
+    'raw': {'relay_raw': True, 'relay_splice': False},
+    'splice': {'relay_raw': True, 'relay_splice': True},
+    'multiplex': {'relay_multiplex': True},
+    # the last bytes of a stream are still held by the coalescer when the user closes, they go out together
+    # with its CloseTunnel right before the relay closes
+    'multiplex-coalesce': {'relay_multiplex': True, 'forward_coalesce': True, 'forward_coalesce_delay': 20000},
+}
+
+
+async def slow_download(deployment: Deployment, size: int, chunk_delay: float) -> int:
+    # reads at a bounded pace, so that the transfer is still running when the manager connection goes
+    reader, writer = await deployment.connect('source')
+    writer.write(SIZE.pack(size))
+    received = 0
+    while True:
+        data = await reader.read(64 * 1024)
+        if not data:
+            break
+        received += len(data)
+        await asyncio.sleep(chunk_delay)
+    writer.close()
+    return received
+
+
+async def wait_counted(count_id: int, timeout: float) -> int:
+    deadline = time.monotonic() + timeout
+    while count_id not in counted:
+        if time.monotonic() > deadline:
+            return -1
+        await asyncio.sleep(0.05)
+    return counted.pop(count_id)
+
+
+async def check_case(settings: Dict[str, Any], event_loop: str, size: int) -> Dict[str, Any]:
+    deployment = Deployment(manager_link=True, event_loop=event_loop, **settings)
+    await deployment.start()
+    try:
+        download = asyncio.ensure_future(slow_download(deployment, size, 0.005))
+        # an upload whose last bytes are written after the reconnect and the download, right before the user closes
+        reader, writer = await deployment.connect('count')
+        writer.write(SIZE.pack(1) + CHUNK)
+        await asyncio.sleep(0.3)
+        deployment.drop_manager()
+        start = time.perf_counter()
+        # a new connection is parked until the client is back, then served
+        await deployment.wait(deployment.probe, 10)
+        reconnect = time.perf_counter() - start
+        downloaded = await asyncio.wait_for(download, 30)
+        # the upload is the last tunnel left on the relays of the old session, they close with it
+        writer.write(b'y' * 100)
+        writer.close()
+        uploaded = await wait_counted(1, 5)
+        return {
+            'reconnect_s': round(reconnect, 2),
+            'download_ok': downloaded == size,
+            'upload_ok': uploaded == len(CHUNK) + 100,
+        }
+    finally:
+        await deployment.stop()
+
+
+@click.command()
+@click.option('--loop', 'event_loop', default='auto', type=click.Choice(['auto', 'asyncio', 'uvloop']),
+              help='event loop of the server and client')
+@click.option('--size', default=16, help='MB of the download in flight')
+@click.option('--case', 'cases', multiple=True, type=click.Choice(list(CASES)), default=list(CASES),
+              help='relay modes to check, all by default')
+def main(event_loop, size, cases):
+    """
+    cut the client's manager connection while a download and an upload are in flight and check that both
+    complete over their relays, for every relay mode: python -m benchmark.failover
+    """
+    click.echo(f'{"case":<20}{"reconnect s":>12}{"download":>10}{"upload":>8}')
+    failed = []
+    for case in cases:
+        result = asyncio.run(check_case(CASES[case], event_loop, size * MB))
+        click.echo(f'{case:<20}{result["reconnect_s"]:>12}{"ok" if result["download_ok"] else "SHORT":>10}'
+                   f'{"ok" if result["upload_ok"] else "SHORT":>8}')
+        if not (result['download_ok'] and result['upload_ok']):
+            failed.append(case)
+    if failed:
+        raise click.ClickException(f'tunnels lost data across the reconnect: {", ".join(failed)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,365 @@
+import os
+import sys
+import time
+import socket
+import struct
+import asyncio
+import multiprocessing
+from functools import partial
+from typing import Dict, Any, List, Optional, Tuple, Set
+
+from loguru import logger
+
+from settings import Settings
+from py_types import TypeEndpoint
+from utils.event_loop import install_event_loop
+from server.workers import settings_snapshot
+
+# source and sink targets read the byte count to send or to receive as !Q, probes send their id that way
+SIZE = struct.Struct('!Q')
+CHUNK = b'x' * 64 * 1024
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def apply_settings(settings: Dict[str, Any]):
+    for k, v in settings.items():
+        setattr(Settings, k, v)
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING')
+
+
+def prepare_process(settings: Dict[str, Any]) -> str:
+    apply_settings(settings)
+    return install_event_loop()
+
+
+def run_server(settings: Dict[str, Any], mappings: List[List]):
+    prepare_process(settings)
+    asyncio.run(serve_server(mappings))
+
+
+async def serve_server(mappings: List[List]):
+    await start_server(mappings)
+    await asyncio.Event().wait()
+
+
+async def start_server(mappings: List[List]) -> 'LocalServer':
+    from server.relay_server import RelayServer
+    from server.manager_server import ManagerServer
+    from server.tenants import TenantRegistry, DEFAULT_TENANT, build_tenant
+    tenants = TenantRegistry(build_tenant)
+    relay_server = RelayServer(tenants)
+    manager_server = ManagerServer(tenants)
+    from mapping import MappingOptions
+    factory = tenants.get(DEFAULT_TENANT).proxy_server_factory
+    await relay_server.start()
+    await manager_server.start()
+    # the defaults of MappingOptions were read from Settings at import, before the deployment's settings applied
+    options = MappingOptions(coalesce=Settings.forward_coalesce, coalesce_delay=Settings.forward_coalesce_delay,
+                             coalesce_bytes=Settings.forward_coalesce_bytes, compression=Settings.compression)
+    for endpoint, bind_port in mappings:
+        await factory.create_server(tuple(endpoint), bind_port, options)
+    return LocalServer(tenants, relay_server, manager_server)
+
+
+class LocalServer(object):
+    # a server running in the caller's loop, its relays and agents can be inspected
+    def __init__(self, tenants, relay_server, manager_server):
+        self.tenants = tenants
+        self.relay_server = relay_server
+        self.manager_server = manager_server
+
+    async def stop(self):
+        for tenant in self.tenants.tenants.values():
+            for endpoint in list(tenant.proxy_server_factory.servers):
+                await tenant.proxy_server_factory.close_server(endpoint)
+        self.relay_server.server.close()
+        self.manager_server.server.close()
+        for protocol in list(self.relay_server.protocols):
+            protocol.transport.abort()
+
+
+def run_client(settings: Dict[str, Any]):
+    from client.manager_client import ManagerClient
+    prepare_process(settings)
+    asyncio.run(ManagerClient().start())
+
+
+async def echo_target(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    while True:
+        data = await reader.read(64 * 1024)
+        if not data:
+            break
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+
+async def source_target(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    size, = SIZE.unpack(await reader.readexactly(SIZE.size))
+    while size > 0:
+        writer.write(CHUNK[:size])
+        size -= len(CHUNK)
+        await writer.drain()
+    writer.close()
+
+
+async def sink_target(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    size, = SIZE.unpack(await reader.readexactly(SIZE.size))
+    while size > 0:
+        size -= len(await reader.read(256 * 1024) or b'')
+    writer.write(b'k')
+    writer.close()
+
+
+# first byte arrival of every probe connection at the backend, by probe id
+probe_arrivals: Dict[int, float] = {}
+
+
+async def probe_target(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    data = await reader.readexactly(SIZE.size)
+    probe_arrivals[SIZE.unpack(data)[0]] = time.perf_counter()
+    writer.write(data)
+    await echo_target(reader, writer)
+
+
+# bytes that reached the backend by the end of every count connection, by connection id
+counted: Dict[int, int] = {}
+
+
+async def count_target(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    count_id, = SIZE.unpack(await reader.readexactly(SIZE.size))
+    received = 0
+    while True:
+        data = await reader.read(256 * 1024)
+        if not data:
+            break
+        received += len(data)
+    counted[count_id] = received
+    writer.close()
+
+
+TARGETS = {'echo': echo_target, 'source': source_target, 'sink': sink_target, 'probe': probe_target,
+           'count': count_target}
+
+
+def peak_rss_kb(pid: int) -> Optional[int]:
+    # VmHWM, the high water mark of the resident set, linux only
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def cpu_seconds(pid: int) -> Optional[float]:
+    # user + system time of the process, linux only
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # the fields after the parenthesized command name, utime and stime are fields 14 and 15
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+class ManagerLink(object):
+    # forwards the client's manager connection to the server in the caller's loop, drop() cuts it like a network
+    # failure would
+    def __init__(self, manager_port: int):
+        self.manager_port = manager_port
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.writers: Set[asyncio.StreamWriter] = set()
+        self.tasks: Set[asyncio.Task] = set()
+
+    async def start(self) -> int:
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        try:
+            await self.forward(reader, writer)
+        finally:
+            self.tasks.discard(task)
+
+    async def forward(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            server_reader, server_writer = await asyncio.open_connection('127.0.0.1', self.manager_port)
+        except OSError:
+            writer.close()
+            return
+        pair = {writer, server_writer}
+        self.writers |= pair
+        await asyncio.gather(self.pipe(reader, server_writer), self.pipe(server_reader, writer))
+        self.writers -= pair
+
+    @staticmethod
+    async def pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                data = await reader.read(64 * 1024)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+        except OSError:
+            pass
+        writer.close()
+
+    def drop(self):
+        for writer in self.writers:
+            writer.transport.abort()
+
+    async def close(self):
+        self.drop()
+        if self.server:
+            self.server.close()
+        if self.tasks:
+            await asyncio.wait(self.tasks, timeout=5)
+
+
+class Deployment(object):
+    # a server and a client process on localhost mapping the TARGETS, which run in the caller's loop.
+    # With manager_link the client's manager connection goes through a ManagerLink, see drop_manager.
+    # With local_server the server runs in the caller's loop too, as self.server, and takes its settings
+    def __init__(self, manager_link: bool = False, local_server: bool = False, **settings):
+        self.settings = {**settings_snapshot(), 'relay_port': free_port(), 'manager_port': free_port(), **settings}
+        self.link = ManagerLink(self.settings['manager_port']) if manager_link else None
+        self.local_server = local_server
+        self.server: Optional[LocalServer] = None
+        self.processes: List[multiprocessing.Process] = []
+        self.targets: List[asyncio.AbstractServer] = []
+        self.ports: Dict[str, int] = {}
+        self.handlers: Set[asyncio.Task] = set()
+        self.probe_id = 0
+
+    async def start(self, timeout: float = 10):
+        mappings = []
+        for name, handler in TARGETS.items():
+            target = await asyncio.start_server(partial(self.track, handler), '127.0.0.1', 0)
+            self.targets.append(target)
+            endpoint: TypeEndpoint = target.sockets[0].getsockname()[:2]
+            self.ports[name] = free_port()
+            mappings.append([endpoint, self.ports[name]])
+        # the client starts once the server listens on the mappings, so it connects at the first try
+        if self.local_server:
+            apply_settings(self.settings)
+            self.server = await start_server(mappings)
+        else:
+            self.spawn(run_server, self.settings, mappings)
+        await self.wait(self.listening, timeout)
+        client_settings = self.settings
+        if self.link:
+            client_settings = {**self.settings, 'manager_port': await self.link.start()}
+        self.spawn(run_client, client_settings)
+        await self.wait(self.probe, timeout)
+
+    async def track(self, handler, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self.handlers.add(task)
+        try:
+            await handler(reader, writer)
+        except (OSError, asyncio.IncompleteReadError):
+            writer.close()
+        finally:
+            self.handlers.discard(task)
+
+    def spawn(self, target, *args):
+        process = multiprocessing.get_context('spawn').Process(target=target, args=args, daemon=True)
+        process.start()
+        self.processes.append(process)
+
+    async def wait(self, probe, timeout: float):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                await asyncio.wait_for(probe(), 1)
+                return
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                if time.monotonic() > deadline:
+                    await self.stop()
+                    raise RuntimeError(f'deployment not ready: {probe.__name__}')
+                await asyncio.sleep(0.1)
+
+    async def listening(self):
+        _, writer = await asyncio.open_connection('127.0.0.1', self.ports['echo'])
+        writer.close()
+
+    async def connect(self, target: str) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        return await asyncio.open_connection('127.0.0.1', self.ports[target])
+
+    async def probe(self) -> float:
+        # seconds from the proxy accepting a connection to its first byte reaching the backend
+        self.probe_id += 1
+        probe_id = self.probe_id
+        reader, writer = await self.connect('probe')
+        accepted = time.perf_counter()
+        try:
+            writer.write(SIZE.pack(probe_id))
+            await reader.readexactly(SIZE.size)
+            return probe_arrivals.pop(probe_id) - accepted
+        finally:
+            writer.close()
+
+    async def download(self, size: int) -> int:
+        reader, writer = await self.connect('source')
+        writer.write(SIZE.pack(size))
+        received = 0
+        while True:
+            data = await reader.read(256 * 1024)
+            if not data:
+                break
+            received += len(data)
+        writer.close()
+        return received
+
+    async def upload(self, size: int) -> int:
+        reader, writer = await self.connect('sink')
+        writer.write(SIZE.pack(size))
+        sent = 0
+        while sent < size:
+            writer.write(CHUNK[:size - sent])
+            sent += len(CHUNK[:size - sent])
+            await writer.drain()
+        await reader.readexactly(1)
+        writer.close()
+        return sent
+
+    def drop_manager(self):
+        # both ends see the manager connection reset, the client reconnects after its backoff
+        self.link.drop()
+
+    @property
+    def process_names(self) -> Tuple[str, ...]:
+        return ('client',) if self.local_server else ('server', 'client')
+
+    def peak_rss_kb(self) -> Dict[str, Optional[int]]:
+        return {name: peak_rss_kb(process.pid) for name, process in zip(self.process_names, self.processes)}
+
+    def cpu_seconds(self) -> Dict[str, Optional[float]]:
+        return {name: cpu_seconds(process.pid) for name, process in zip(self.process_names, self.processes)}
+
+    async def stop(self):
+        # client first, the server going away would make it reconnect
+        for process in reversed(self.processes):
+            process.terminate()
+            process.join()
+        if self.server:
+            await self.server.stop()
+        for target in self.targets:
+            target.close()
+        if self.link:
+            await self.link.close()
+        # backend connections end with the client process, let their handlers see it
+        if self.handlers:
+            await asyncio.wait(self.handlers, timeout=5)
@@ -0,0 +1,64 @@
+import asyncio
+import time
+
+import click
+
+from benchmark.harness import Deployment
+from benchmark.workloads import MB
+
+GB = 2 ** 30
+
+
+# settings of each mode, splice moves raw tunnels in the kernel on linux with python 3.10+
+MODES = {
+    'framed': {'relay_raw': False},
+    'raw': {'relay_raw': True, 'relay_splice': False},
+    'splice': {'relay_raw': True, 'relay_splice': True},
+}
+
+
+async def bench_mode(settings, event_loop: str, streams: int, size: int):
+    # relay reuse does not matter to bulk transfers, each one holds its relay until the end
+    deployment = Deployment(event_loop=event_loop, **settings)
+    await deployment.start()
+    try:
+        result = {}
+        for direction, transfer in (('download', deployment.download), ('upload', deployment.upload)):
+            cpu_before = deployment.cpu_seconds()
+            start = time.perf_counter()
+            done = sum(await asyncio.gather(*[transfer(size) for _ in range(streams)]))
+            elapsed = time.perf_counter() - start
+            cpu_after = deployment.cpu_seconds()
+            assert done == streams * size, f'short {direction}'
+            result[direction] = {
+                'mb_per_s': round(done / elapsed / MB, 1),
+                **{f'{name}_cpu_s_per_gb': round((cpu_after[name] - cpu_before[name]) / (done / GB), 2)
+                   for name in ('server', 'client')},
+            }
+        return result
+    finally:
+        await deployment.stop()
+
+
+@click.command()
+@click.option('--loop', 'event_loop', default='auto', type=click.Choice(['auto', 'asyncio', 'uvloop']),
+              help='event loop of the server and client')
+@click.option('--streams', default=4, help='concurrent transfers')
+@click.option('--size', default=256, help='MB per transfer')
+@click.option('--mode', 'modes', multiple=True, type=click.Choice(list(MODES)), default=list(MODES),
+              help='modes to compare, all by default')
+def main(event_loop, streams, size, modes):
+    """
+    compare throughput and cpu seconds per GB of the server and client with Forward framing, with raw
+    passthrough on dedicated relays and with raw tunnels spliced in the kernel: python -m benchmark.passthrough
+    """
+    click.echo(f'{"mode":<8}{"direction":<10}{"MB/s":>8}{"server cpu s/GB":>18}{"client cpu s/GB":>18}')
+    for mode in modes:
+        result = asyncio.run(bench_mode(MODES[mode], event_loop, streams, size * MB))
+        for direction, row in result.items():
+            click.echo(f'{mode:<8}{direction:<10}{row["mb_per_s"]:>8}'
+                       f'{row["server_cpu_s_per_gb"]:>18}{row["client_cpu_s_per_gb"]:>18}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import time
+import asyncio
+from typing import Dict, Any
+
+import click
+
+from benchmark.harness import Deployment, SIZE
+from benchmark.workloads import MB
+
+# reused relay modes, a tunnel ending while its relay is paused must still give the relay back
+CASES = {
+    'reused': {'relay_reuse': True, 'forward_coalesce': False},
+    'reused-coalesce': {'relay_reuse': True, 'forward_coalesce': True},
+}
+
+
+async def wait_for(condition, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.05)
+    return True
+
+
+async def check_case(settings: Dict[str, Any], event_loop: str, size: int) -> Dict[str, Any]:
+    deployment = Deployment(local_server=True, event_loop=event_loop, **settings)
+    await deployment.start()
+    server = deployment.server
+    try:
+        relays = server.relay_server.protocols
+        # a download the user never reads: the proxy stops writing and pauses the relay it comes from
+        reader, writer = await deployment.connect('source')
+        writer.write(SIZE.pack(size))
+        paused = await wait_for(lambda: any(p.in_tunnel and not p.transport.is_reading() for p in relays), 10)
+        writer.transport.abort()
+
+        def recycled():
+            agents = [agent for tenant in server.tenants.tenants.values()
+                      for agent in tenant.broadcaster.agents.values()]
+            return not any(p.in_tunnel for p in relays) and all(agent.load.tunnels == 0 for agent in agents)
+        return {'paused': paused, 'recycled': await wait_for(recycled, 5)}
+    finally:
+        await deployment.stop()
+
+
+@click.command()
+@click.option('--loop', 'event_loop', default='auto', type=click.Choice(['auto', 'asyncio', 'uvloop']),
+              help='event loop of the server and client')
+@click.option('--size', default=64, help='MB of the download the user stops reading')
+@click.option('--case', 'cases', multiple=True, type=click.Choice(list(CASES)), default=list(CASES),
+              help='relay modes to check, all by default')
+def main(event_loop, size, cases):
+    """
+    abort a user connection while its relay is paused by the tunnel's backpressure and check that the relay
+    ends the tunnel and goes back to the pool, the server runs in this process: python -m benchmark.paused_close
+    """
+    click.echo(f'{"case":<20}{"paused":>8}{"recycled":>10}')
+    failed = []
+    for case in cases:
+        result = asyncio.run(check_case(CASES[case], event_loop, size * MB))
+        click.echo(f'{case:<20}{"yes" if result["paused"] else "no":>8}'
+                   f'{"ok" if result["recycled"] else "LEAKED":>10}')
+        if not (result['paused'] and result['recycled']):
+            failed.append(case)
+    if failed:
+        raise click.ClickException(f'relays not paused or not recycled: {", ".join(failed)}')
+
+
+if __name__ == '__main__':
+    main()
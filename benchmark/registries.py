@@ -0,0 +1,84 @@
+import gc
+import time
+import random
+import asyncio
+
+import click
+
+from broadcaster import BroadCaster
+from mapping import MappingOptions
+from server.relay_pool import RelayPool
+from server.proxy_server import ProxyServer, ProxyServerFactory
+
+
+class IdleRelay(object):
+    # what the pool reads of a relay: the agent it belongs to
+    manager_protocol = None
+
+
+def per_op_us(elapsed: float, count: int) -> float:
+    return round(elapsed / count * 1e6, 3)
+
+
+async def proxy_close_cost(count: int) -> float:
+    # connections of one mapping closing in random order, through the close waiter callback
+    server = ProxyServer(1, ('127.0.0.1', 80), MappingOptions())
+    protocols = [server.build_protocol(None) for _ in range(count)]
+    random.shuffle(protocols)
+    start = time.perf_counter()
+    for protocol in protocols:
+        protocol.close_waiter.set_result(protocol)
+    await asyncio.sleep(0)  # done callbacks run in the next loop iteration
+    elapsed = time.perf_counter() - start
+    assert not server.protocols
+    return per_op_us(elapsed, count)
+
+
+async def pool_remove_cost(count: int) -> float:
+    # idle relays leaving the pool in random order, as closed relays do
+    pool = RelayPool(BroadCaster())
+    relays = [IdleRelay() for _ in range(count)]
+    for relay in relays:
+        pool.put_nowait(relay)
+    random.shuffle(relays)
+    start = time.perf_counter()
+    for relay in relays:
+        pool.remove(relay)
+    elapsed = time.perf_counter() - start
+    assert pool.empty()
+    return per_op_us(elapsed, count)
+
+
+async def server_lookup_cost(count: int) -> float:
+    factory = ProxyServerFactory(None, None, BroadCaster())
+    for server_id in range(1, count + 1):
+        server = ProxyServer(server_id, ('127.0.0.1', server_id), MappingOptions())
+        factory.servers[server.endpoint] = server
+        factory.servers_by_id[server_id] = server
+    ids = random.sample(range(1, count + 1), min(count, 10000))
+    start = time.perf_counter()
+    for server_id in ids:
+        assert factory.get_server_by_id(server_id) is not None
+    return per_op_us(time.perf_counter() - start, len(ids))
+
+
+@click.command()
+@click.option('--size', 'sizes', multiple=True, type=int, default=(100, 1000, 10000, 100000),
+              help='connections, relays or servers in the registry')
+def main(sizes):
+    """
+    cost per operation of the connection, relay pool and server registries as they grow:
+    python -m benchmark.registries
+    """
+    click.echo(f'{"size":>8}{"proxy close us":>16}{"pool remove us":>16}{"server lookup us":>18}')
+    # collector passes over the objects built for the bigger sizes would swamp the timings
+    gc.disable()
+    for size in sizes:
+        close, remove, lookup = (asyncio.run(bench(size)) for bench in
+                                 (proxy_close_cost, pool_remove_cost, server_lookup_cost))
+        gc.collect()
+        click.echo(f'{size:>8}{close:>16}{remove:>16}{lookup:>18}')
+
+
+if __name__ == '__main__':
+    main()
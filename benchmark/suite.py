@@ -0,0 +1,73 @@
+import json
+import platform
+import subprocess
+import asyncio
+from typing import Dict, Any, Tuple, Optional
+
+import click
+
+from settings import Settings
+from benchmark.harness import Deployment
+from benchmark.workloads import WORKLOADS
+
+
+def parse_setting(item: str) -> Tuple[str, Any]:
+    name, _, value = item.partition('=')
+    if not hasattr(Settings, name):
+        raise click.BadParameter(f'unknown setting {name}')
+    current = getattr(Settings, name)
+    if isinstance(current, bool):
+        return name, value.lower() in ('1', 'true', 'yes')
+    if isinstance(current, (int, float)):
+        return name, type(current)(value)
+    return name, value
+
+
+def current_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_workload(name: str, settings: Dict[str, Any]) -> Dict[str, Any]:
+    # every workload gets fresh processes, so the peak rss is its own
+    deployment = Deployment(**settings)
+    await deployment.start()
+    try:
+        result = await WORKLOADS[name](deployment)
+        result['peak_rss_kb'] = deployment.peak_rss_kb()
+    finally:
+        await deployment.stop()
+    return result
+
+
+@click.command()
+@click.option('--workload', 'workloads', multiple=True, type=click.Choice(list(WORKLOADS)), default=list(WORKLOADS),
+              help='workloads to run, all by default')
+@click.option('--set', 'overrides', multiple=True, metavar='NAME=VALUE',
+              help='settings of the server and client, e.g. --set relay_multiplex=1')
+@click.option('--json', 'json_path', type=click.Path(dir_okay=False, writable=True),
+              help='write the results to this file')
+def main(workloads, overrides, json_path):
+    """
+    run the loopback benchmark workloads against a server and a client process: python -m benchmark.suite
+    """
+    settings = dict(parse_setting(item) for item in overrides)
+    report = {
+        'commit': current_commit(),
+        'python': platform.python_version(),
+        'settings': settings,
+        'results': {},
+    }
+    for name in workloads:
+        result = asyncio.run(run_workload(name, settings))
+        report['results'][name] = result
+        click.echo(f'{name}: {json.dumps(result)}')
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+import time
+import asyncio
+from typing import Dict, Any, List
+
+from benchmark.harness import Deployment
+
+MB = 2 ** 20
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def latency_summary(latencies: List[float], prefix: str) -> Dict[str, float]:
+    return {
+        f'{prefix}_p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        f'{prefix}_p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+async def bulk(deployment: Deployment, streams: int = 8, size: int = 64 * MB) -> Dict[str, Any]:
+    # concurrent downloads then concurrent uploads through their own tunnels
+    result = {}
+    for direction, transfer in (('download', deployment.download), ('upload', deployment.upload)):
+        start = time.perf_counter()
+        done = await asyncio.gather(*[transfer(size) for _ in range(streams)])
+        elapsed = time.perf_counter() - start
+        assert sum(done) == streams * size, f'short {direction}'
+        result[f'{direction}_mb_per_s'] = round(sum(done) / elapsed / MB, 1)
+    return result
+
+
+async def short(deployment: Deployment, connections: int = 2000, concurrency: int = 32) -> Dict[str, Any]:
+    # many short connections, each one probe round trip, with a bounded number in flight
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            latencies.append(await deployment.probe())
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(connections)])
+    elapsed = time.perf_counter() - start
+    return {'connections_per_s': round(connections / elapsed, 1), **latency_summary(latencies, 'setup')}
+
+
+async def setup(deployment: Deployment, connections: int = 500) -> Dict[str, Any]:
+    # sequential tunnels on an otherwise idle deployment
+    latencies = [await deployment.probe() for _ in range(connections)]
+    return latency_summary(latencies, 'setup')
+
+
+async def idle(deployment: Deployment, connections: int = 1000, hold: float = 5) -> Dict[str, Any]:
+    # many long connections that stay open with nothing to send, then all of them are used once more
+    streams = []
+    start = time.perf_counter()
+    for _ in range(connections):
+        reader, writer = await deployment.connect('echo')
+        writer.write(b'p')
+        await reader.readexactly(1)
+        streams.append((reader, writer))
+    opened = time.perf_counter() - start
+    await asyncio.sleep(hold)
+
+    async def ping(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+        writer.write(b'p')
+        try:
+            await asyncio.wait_for(reader.readexactly(1), 10)
+            return True
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, OSError):
+            return False
+
+    alive = await asyncio.gather(*[ping(*stream) for stream in streams])
+    for _, writer in streams:
+        writer.close()
+    return {'open_seconds': round(opened, 3), 'alive': sum(alive)}
+
+
+async def interactive(deployment: Deployment, connections: int = 16, messages: int = 500,
+                      size: int = 64) -> Dict[str, Any]:
+    # request/response of small messages on a few long connections, like a shell or rdp session
+    latencies = []
+    payload = b'i' * size
+
+    async def session():
+        reader, writer = await deployment.connect('echo')
+        for _ in range(messages):
+            start = time.perf_counter()
+            writer.write(payload)
+            await reader.readexactly(size)
+            latencies.append(time.perf_counter() - start)
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[session() for _ in range(connections)])
+    elapsed = time.perf_counter() - start
+    return {'messages_per_s': round(connections * messages / elapsed, 1), **latency_summary(latencies, 'rtt')}
+
+
+WORKLOADS = {'bulk': bulk, 'short': short, 'setup': setup, 'idle': idle, 'interactive': interactive}
@@ -15,15 +15,23 @@ class BroadCaster(object):
         from server.manager_server import ManagerProtocol
         self.watchers = defaultdict(set)
         self.handlers: Dict[Event,  List[TypeEventHandler]] = defaultdict(list)
+        # the latest connected client agent, None while no agent is connected
         self.manager_protocol: ManagerProtocol = None
-
+        # every connected agent by manager session id, more than one with Settings.multi_agent
+        self.agents: Dict[str, ManagerProtocol] = {}
 
     def listen_events(self, event: Event, payload):
         if event == Event.ManagerProtocolValid:
+            self.agents[payload.session_id] = payload
             self.manager_protocol = payload
         elif event == Event.ManagerProtocolClose:
+            if self.agents.get(payload.session_id) is payload:
+                del self.agents[payload.session_id]
             if self.manager_protocol is payload:
-                self.manager_protocol = None
+                self.manager_protocol = list(self.agents.values())[-1] if self.agents else None
+
+    def agent_alive(self, agent) -> bool:
+        return agent is not None and self.agents.get(agent.session_id) is agent
 
     def fire(self, event: Event, payload=None):
         assert event != Event.All, 'Event All cannot be fired'
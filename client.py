@@ -1,9 +1,12 @@
 import asyncio
 
 from client.manager_client import ManagerClient
+from utils.event_loop import install_event_loop
 
 if __name__ == '__main__':
-    loop = asyncio.get_event_loop()
+    install_event_loop()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
     manager = ManagerClient()
     loop.run_until_complete(manager.start())
     loop.run_forever()
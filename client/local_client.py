@@ -1,18 +1,66 @@
-from typing import Dict, Any, Union, Optional
+from typing import Dict, Any, Union, Optional, List
 
-from protocols import ImitateHttpProtocol, CommandEnum
+from settings import Settings
+from protocols import BaseProtocol
 from tunnel import Tunnel, TunnelPoint
 
 
-class LocalProtocol(ImitateHttpProtocol, TunnelPoint):
+class LocalProtocol(BaseProtocol, TunnelPoint):
+    def __init__(self):
+        super().__init__()
+        # a warm tunnel's local connection is held until the server splices a connection onto it: what the
+        # local service sends meanwhile is kept, reading goes on so that a close by the service is noticed
+        self.held = False
+        self.held_data: List[bytes] = []
+        self.held_size = 0
+        self.tunnel_paused = False
+
+    def hold(self):
+        self.held = True
+
+    def release(self):
+        self.held = False
+        while self.held_data:
+            self.tunnel.write(self, self.held_data.pop(0))
+        self.held_size = 0
+        self.update_reading()
+
+    def update_reading(self):
+        if self.tunnel_paused or self.held_size >= Settings.write_buffer_high:
+            self.transport.pause_reading()
+        else:
+            self.transport.resume_reading()
+
     def on_tunnel_write(self, data: bytes):
         self.transport.write(data)
 
     def on_tunnel_close(self, exc: Optional[Exception]):
         self.transport.close()
 
+    def splice_ready(self) -> bool:
+        return not (self.held or self.transport.is_closing() or self.transport.get_write_buffer_size())
+
+    def on_tunnel_pause(self):
+        self.tunnel_paused = True
+        self.update_reading()
+
+    def on_tunnel_resume(self):
+        self.tunnel_paused = False
+        self.update_reading()
+
+    def pause_writing(self):
+        self.tunnel.pause(self)
+
+    def resume_writing(self):
+        self.tunnel.resume(self)
+
     def data_received(self, data: bytes):
-        self.tunnel.write(self, data)
+        if self.held:
+            self.held_data.append(data)
+            self.held_size += len(data)
+            self.update_reading()
+        else:
+            self.tunnel.write(self, data)
 
     def connection_lost(self, exc: Optional[Exception]) -> None:
         self.tunnel.close(self, exc)
@@ -1,7 +1,9 @@
+import os
 import sys
+import json
+import socket
 from typing import Dict, Any, Optional
 import asyncio
-from asyncio.selector_events import _SelectorSocketTransport
 from functools import partial
 
 from loguru import logger
@@ -9,60 +11,82 @@ from loguru import logger
 from settings import Settings
 from protocols import ImitateHttpProtocol, CommandEnum
 from utils.sockets import create_connection, set_socket_keepalive
-from client.relay_client import RelayClient
+from client.relay_client import connect_times
+from client.supervisor import Backoff, RelayDialer
 
 
 class ManagerProtocol(ImitateHttpProtocol):
-    def __init__(self, close_event: asyncio.Event):
+    def __init__(self, close_event: asyncio.Event, dialer: RelayDialer, backoff: Backoff):
         super().__init__()
         self.close_event = close_event
+        self.dialer = dialer
+        self.backoff = backoff
         self.tasks = set()
+        self.metrics_handle: Optional[asyncio.TimerHandle] = None
 
-    def connection_made(self, transport: _SelectorSocketTransport):
+    def connection_made(self, transport: asyncio.Transport):
         super().connection_made(transport)
-        self.send(CommandEnum.AuthRequire, headers={'AuthToken': Settings.auth_token})
+        self.send(CommandEnum.AuthRequire, headers={
+            'AuthToken': Settings.auth_token,
+            'Framing': Settings.framing,
+            'Multiplex': int(Settings.relay_multiplex),
+            'AgentId': Settings.agent_id or '%s:%s' % (socket.gethostname(), os.getpid())
+        })
         sock = transport.get_extra_info('socket')
         set_socket_keepalive(sock)
 
     def on_command_complete(self, command: CommandEnum, headers: Dict[str, Any]):
         if command == CommandEnum.NewReplier:
             replier_num = int(headers['ReplierNum'])
-            for i in range(replier_num):
-                loop = asyncio.get_event_loop()
-                loop.create_task(
-                    create_connection(
-                        partial(RelayClient, headers['ManagerSessionId']),
-                        Settings.relay_host,
-                        Settings.relay_port
-                    )
-                )
+            relay_port = int(headers.get('RelayPort', Settings.relay_port))
+            self.dialer.request(headers['ManagerSessionId'], replier_num, relay_port)
         elif command == CommandEnum.AuthSuccess:
             logger.success('Manager Connect Success')
+            self.backoff.reset()
+            if Settings.client_metrics_interval:
+                self.metrics_handle = self._loop.call_later(Settings.client_metrics_interval, self.report_metrics)
         elif command == CommandEnum.ManagerKickOut:
             sys.exit(0)
 
+    def report_metrics(self):
+        self.send(CommandEnum.ClientMetrics, headers={
+            'ConnectTimes': json.dumps({endpoint: h.dict() for endpoint, h in connect_times.items()}),
+            'RelayDials': json.dumps(self.dialer.stats.dict())
+        })
+        self.metrics_handle = self._loop.call_later(Settings.client_metrics_interval, self.report_metrics)
+
     def connection_lost(self, exc: Optional[Exception]) -> None:
+        if self.metrics_handle:
+            self.metrics_handle.cancel()
+        self.dialer.end_session()
         self.close_event.set()
 
 
 class ManagerClient(object):
     async def start(self):
+        # created in the running loop, asyncio primitives bind to the loop of their creation before python 3.10
+        dialer = RelayDialer()
+        backoff = Backoff(Settings.manager_retry_min, Settings.manager_retry_max)
         while True:
             close_event = asyncio.Event()
             try:
                 _, client = await create_connection(
-                    partial(ManagerProtocol, close_event),
+                    partial(ManagerProtocol, close_event, dialer, backoff),
                     Settings.manager_host,
-                    Settings.manager_port
+                    Settings.manager_port,
+                    Settings.relay_dial_timeout
                 )
             except Exception as e:
-                logger.warning(f'ManagerClient<{Settings.manager_host}:{Settings.manager_port}> connect fail')
-                close_event.set()
-                await asyncio.sleep(1)
+                delay = backoff.next_delay()
+                logger.warning(f'ManagerClient<{Settings.manager_host}:{Settings.manager_port}> connect fail, '
+                               f'retry in {delay:.1f}s')
+                await asyncio.sleep(delay)
                 continue
             # logger.info(f'ManagerClient<{Settings.manager_host}:{Settings.manager_port}> connect success')
             await close_event.wait()
             logger.warning(f'ManagerClient<{Settings.manager_host}:{Settings.manager_port}> disconnect')
+            # a server restart disconnects every site at once, they must not all come back at once
+            await asyncio.sleep(backoff.next_delay())
 
 
 if __name__ == '__main__':
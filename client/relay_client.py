@@ -1,16 +1,78 @@
+from collections import defaultdict
 from typing import Dict, Any, Union, Optional
 import asyncio
 from asyncio.tasks import Task
 from asyncio import CancelledError, Queue
-from asyncio.selector_events import _SelectorSocketTransport
 
 
 from settings import Settings
 from py_types import TypeEndpoint
 from utils.sockets import create_connection
-from protocols import ImitateHttpProtocol, CommandEnum
+from protocols import ImitateHttpProtocol, CommandEnum, FRAME_FLAG_COMPRESSED
 from client.local_client import LocalProtocol
-from tunnel import Tunnel, TunnelPoint
+from tunnel import Tunnel, TunnelPoint, FakeCloseTunnel, ForwardCoalescer
+from mapping import MappingOptions, MappingStats
+from compression import CODECS, ForwardCompressor
+from multiplex import Multiplexer, MultiplexStream
+from splice import SPLICE_AVAILABLE, start_splice
+from metrics import Histogram
+
+# Forward frames sent towards the server, over all tunnels of this client
+forward_stats = MappingStats()
+# seconds to connect to the local endpoint, by endpoint as named in NewTunnel, reported to the server
+connect_times: Dict[str, Histogram] = defaultdict(Histogram)
+
+
+async def connect_local(endpoint: TypeEndpoint) -> LocalProtocol:
+    start = asyncio.get_event_loop().time()
+    _, client = await create_connection(LocalProtocol, *endpoint)
+    connect_times['%s:%s' % tuple(endpoint)].observe(asyncio.get_event_loop().time() - start)
+    return client
+
+
+class LocalStream(MultiplexStream):
+    def __init__(self, multiplexer: Multiplexer, stream_id: int, window: Optional[int] = None):
+        super().__init__(multiplexer, stream_id, window)
+        self.body_buffers = []
+        self.task: Optional[Task] = None
+        self.options: Optional[MappingOptions] = None
+
+    def on_new_tunnel(self, headers: Dict[str, Any]):
+        self.options = MappingOptions.from_headers(headers)
+        self.set_codec(self.options.compression)
+        endpoint: TypeEndpoint = headers['Endpoint'].split(':')
+        self.task = asyncio.get_event_loop().create_task(self.create_local_connection(endpoint))
+
+    def feed(self, body: memoryview):
+        if isinstance(self.tunnel, FakeCloseTunnel):
+            self.body_buffers.append(bytes(self.decode(body)))
+        else:
+            self.deliver(self.decode(body))
+
+    def remote_close(self):
+        if self.task:
+            self.task.cancel()
+        self.body_buffers = []
+        super().remote_close()
+
+    def relay_lost(self, exc: Optional[Exception]):
+        if self.task:
+            self.task.cancel()
+        self.body_buffers = []
+        super().relay_lost(exc)
+
+    async def create_local_connection(self, endpoint: TypeEndpoint):
+        try:
+            client = await connect_local(endpoint)
+        except CancelledError:  # closed by remote
+            return
+        except Exception as e:
+            self.on_tunnel_close(e)
+            return
+        tunnel = Tunnel(self, client, options=self.options, stats=forward_stats)
+        tunnel.build()
+        while self.body_buffers:
+            self.deliver(self.body_buffers.pop(0))
 
 
 class RelayClient(ImitateHttpProtocol, TunnelPoint):
@@ -20,49 +82,223 @@ class RelayClient(ImitateHttpProtocol, TunnelPoint):
         self.tunnel: Optional[Tunnel] = None
         self.task: Optional[Task] = None
         self.session_id = session_id
+        self.multiplexer: Optional[Multiplexer] = None
+        # set by the server per tunnel when it ends tunnels in-band instead of closing the relay
+        self.reusable = False
+        self.close_sent = False
+        self.close_received = False
+        self.write_paused = False
+        self.options: Optional[MappingOptions] = None
+        self.coalescer: Optional[ForwardCoalescer] = None
+        self.compressor: Optional[ForwardCompressor] = None
+        self.decompressor = None
+        self.receive_compressed = False
+        self.compress_paused = False
+        # NewTunnel of a warm tunnel: open the local connection, forward from it only from TunnelActivate on
+        self.warm = False
+        # the server switched the relay to raw passthrough at NewTunnel
+        self.raw_tunnel = False
+        # the raw tunnel goes to the kernel as soon as no bytes of it are buffered in python
+        self.splice_wanted = False
 
-    def connection_made(self, transport: _SelectorSocketTransport):
+    def connection_made(self, transport: asyncio.Transport):
         super().connection_made(transport)
         self.send(CommandEnum.AuthRequire, headers={
             'AuthToken': Settings.auth_token,
-            'ManagerSessionId': self.session_id
+            'ManagerSessionId': self.session_id,
+            'Framing': Settings.framing,
+            'Multiplex': int(Settings.relay_multiplex),
+            'RelayReuse': int(Settings.relay_reuse),
+            'Compression': ','.join(CODECS),
+            'Warm': 1,
+            'Raw': 1
         })
         self.send(CommandEnum.ClientReady)
 
     def on_command_complete(self, command: CommandEnum, headers: Dict[str, Any]):
-        if command == CommandEnum.NewTunnel:
+        if 'StreamId' in headers:
+            if self.multiplexer is None:
+                self.multiplexer = Multiplexer(self, LocalStream)
+            self.multiplexer.command_complete(command, headers)
+        elif command == CommandEnum.NewTunnel:
             assert self.tunnel is None, 'repeat new Tunnel command'
+            self.reusable = headers.get('RelayReuse') == '1'
+            self.warm = headers.get('Warm') == '1'
+            self.options = MappingOptions.from_headers(headers)
+            codec = self.options.compression
+            self.decompressor = CODECS[codec].decompressor() if codec else None
+            if headers.get('Raw') == '1':
+                # the bytes following NewTunnel are raw, so are ours following TunnelRaw
+                self.raw_tunnel = True
+                self.splice_wanted = Settings.relay_splice and SPLICE_AVAILABLE
+                self.send(CommandEnum.TunnelRaw)
+                self.switch_raw()
             endpoint: TypeEndpoint = headers['Endpoint'].split(':')
             self.task = asyncio.get_event_loop().create_task(self.create_local_connection(endpoint))
+        elif command == CommandEnum.Forward:
+            self.receive_compressed = 'Compressed' in headers
+        elif command == CommandEnum.CloseTunnel:
+            self.on_remote_tunnel_close()
+        elif command == CommandEnum.TunnelActivate:
+            # the local connection may have closed meanwhile, our CloseTunnel ends the new tunnel then
+            if self.tunnel and not self.close_sent:
+                self.warm = False
+                self.tunnel.client.release()
 
-    def on_body_stream(self, body: bytes):
+    def on_body_stream(self, body: memoryview):
+        if self.multiplexer:
+            self.multiplexer.body_stream(body)
+            return
+        if self.close_sent:  # tail of a tunnel we already ended
+            return
+        if self.receive_compressed:
+            body = self.decompressor.decompress(body)
         if self.tunnel:
             self.tunnel.write(self, body)
         else:
-            self.body_buffers.append(body)
+            self.body_buffers.append(bytes(body))
+
+    def on_raw_data(self, data: Union[bytes, memoryview]):
+        if self.tunnel:
+            self.tunnel.write(self, data)
+            if self.splice_wanted:
+                self.try_splice()
+        else:
+            self.body_buffers.append(bytes(data))
+
+    def try_splice(self):
+        local = self.tunnel.client
+        if self.body_buffers or self.transport.is_closing() or self.transport.get_write_buffer_size() \
+                or not local.splice_ready():
+            return
+        self.splice_wanted = False
+        start_splice(self.tunnel, local.transport, self.transport)
+
+    def on_tunnel_build(self, tunnel: Tunnel):
+        super().on_tunnel_build(tunnel)
+        if self.raw_tunnel:
+            return
+        self.compress_paused = False
+        self.compressor = ForwardCompressor(tunnel.options.compression, self.send_forward, self.on_compress_busy,
+                                            tunnel.stats)
+        self.coalescer = ForwardCoalescer(self.compressor.write, tunnel.options, tunnel.stats)
 
     def on_tunnel_write(self, data: bytes):
-        self.send(CommandEnum.Forward, body=data)
+        if self.raw_tunnel:
+            self.transport.write(data)
+            if self.splice_wanted:
+                self.try_splice()
+        else:
+            self.coalescer.write(data)
+
+    def send_forward(self, data: bytes, compressed: bool = False, size: Optional[int] = None):
+        self.send(CommandEnum.Forward, body=data, flags=FRAME_FLAG_COMPRESSED if compressed else 0)
+
+    def on_compress_busy(self, busy: bool):
+        self.compress_paused = busy
+        self.update_source()
+
+    def update_source(self):
+        if self.write_paused or self.compress_paused:
+            self.tunnel.pause(self)
+        else:
+            self.tunnel.resume(self)
+
+    def on_tunnel_pause(self):
+        self.transport.pause_reading()
+
+    def on_tunnel_resume(self):
+        self.transport.resume_reading()
+
+    def pause_writing(self):
+        self.write_paused = True
+        if self.multiplexer:
+            self.multiplexer.pause_streams()
+        elif self.tunnel:
+            self.update_source()
+
+    def resume_writing(self):
+        self.write_paused = False
+        if self.multiplexer:
+            self.multiplexer.resume_streams()
+        elif self.tunnel:
+            self.update_source()
 
     def on_tunnel_close(self, exc: Optional[Exception]):
-        self.transport.close()
+        # reading may be paused by the tunnel's backpressure, the server's CloseTunnel must still be read
+        self.transport.resume_reading()
+        # everything our side wrote goes out before the tunnel ends
+        if self.coalescer:
+            self.coalescer.flush()
+            self.compressor.finish(self.end_tunnel)
+        else:
+            self.end_tunnel()
+
+    def end_tunnel(self):
+        if not self.reusable:
+            self.close()
+            return
+        self.close_sent = True
+        self.send(CommandEnum.CloseTunnel)
+        self.try_reset()
+
+    def on_remote_tunnel_close(self):
+        self.close_received = True
+        if self.task:
+            self.task.cancel()
+        if self.coalescer:
+            self.coalescer.discard()
+            self.compressor.discard()
+        self.body_buffers = []
+        if self.tunnel:
+            self.tunnel.close(self)
+        if not self.close_sent:
+            self.close_sent = True
+            self.send(CommandEnum.CloseTunnel)
+        self.try_reset()
+
+    def try_reset(self):
+        # ready for the next NewTunnel once both sides said CloseTunnel
+        if not (self.close_sent and self.close_received):
+            return
+        self.close_sent = self.close_received = False
+        self.tunnel = None
+        self.task = None
+        self.coalescer = None
+        self.compressor = None
+        self.transport.resume_reading()
+
+    def on_stream_close(self, stream: LocalStream):
+        pass
 
     def connection_lost(self, exc: Optional[Exception]) -> None:
         if self.task:
             self.task.cancel()
+        if self.multiplexer:
+            self.multiplexer.close(exc)
+        if self.coalescer:
+            self.coalescer.discard()
+            self.compressor.discard()
         self.body_buffers = []
         if self.tunnel:
             self.tunnel.close(self)
 
     async def create_local_connection(self, endpoint: TypeEndpoint):
         try:
-            _, client = await create_connection(LocalProtocol, *endpoint)
-            self.tunnel = Tunnel(self, client)
+            client = await connect_local(endpoint)
+            self.tunnel = Tunnel(self, client, options=self.options, stats=forward_stats)
             self.tunnel.build()
+            if self.write_paused:
+                self.tunnel.pause(self)
+            if self.warm:
+                client.hold()
+                self.send(CommandEnum.TunnelReady)
             while self.body_buffers:
                 self.tunnel.write(self, self.body_buffers.pop(0))
+            if self.splice_wanted:
+                self.try_splice()
         except CancelledError:  # closed by remote
             pass
         except Exception as e:
-            self.transport.close()
+            self.on_tunnel_close(e)
 
@@ -0,0 +1,87 @@
+import random
+import asyncio
+from typing import Optional, Set, Dict, Any
+from functools import partial
+
+from loguru import logger
+
+from settings import Settings
+from metrics import Histogram
+from utils.sockets import create_connection
+from client.relay_client import RelayClient
+
+
+class Backoff(object):
+    # exponential delays with full jitter, so that clients cut off by the same server restart spread out
+    def __init__(self, minimum: float, maximum: float):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.attempts = 0
+
+    def next_delay(self) -> float:
+        delay = random.uniform(0, min(self.maximum, self.minimum * 2 ** self.attempts))
+        self.attempts += 1
+        return delay
+
+    def reset(self):
+        self.attempts = 0
+
+
+class DialStats(object):
+    def __init__(self):
+        self.successes = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.dropped = 0  # queued for a manager session that ended before their turn
+        self.latency = Histogram()  # seconds to connect a relay
+
+    def dict(self) -> Dict[str, Any]:
+        return {
+            'successes': self.successes,
+            'failures': self.failures,
+            'timeouts': self.timeouts,
+            'dropped': self.dropped,
+            'latency': self.latency.dict(),
+        }
+
+
+class RelayDialer(object):
+    # opens the relays the server asks for with NewReplier: at most relay_dial_concurrency at a time,
+    # each given up after relay_dial_timeout
+    def __init__(self):
+        self.semaphore = asyncio.Semaphore(Settings.relay_dial_concurrency)
+        self.session_id: Optional[str] = None
+        self.tasks: Set[asyncio.Task] = set()
+        self.stats = DialStats()
+
+    def request(self, session_id: str, num: int, relay_port: int):
+        self.session_id = session_id
+        loop = asyncio.get_event_loop()
+        for _ in range(num):
+            task = loop.create_task(self.dial(session_id, relay_port))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def end_session(self):
+        # the server rejects relays of an ended session, the queued dials are not worth making
+        self.session_id = None
+
+    async def dial(self, session_id: str, relay_port: int):
+        async with self.semaphore:
+            if session_id != self.session_id:
+                self.stats.dropped += 1
+                return
+            loop = asyncio.get_event_loop()
+            start = loop.time()
+            try:
+                await create_connection(partial(RelayClient, session_id), Settings.relay_host, relay_port,
+                                        Settings.relay_dial_timeout)
+            except asyncio.TimeoutError:
+                self.stats.timeouts += 1
+                logger.warning(f'Relay<{Settings.relay_host}:{relay_port}> connect timeout')
+            except OSError as e:
+                self.stats.failures += 1
+                logger.warning(f'Relay<{Settings.relay_host}:{relay_port}> connect fail: {e}')
+            else:
+                self.stats.successes += 1
+                self.stats.latency.observe(loop.time() - start)
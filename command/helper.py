@@ -1,5 +1,6 @@
 import os
 import sys
+import json
 import click
 import requests
 
@@ -11,6 +12,8 @@ from settings import Settings
 
 
 BASE_URL = f'http://{Settings.http_command_host}:{Settings.http_command_port}'
+# carries the tenant the command acts on
+api = requests.Session()
 
 
 class EndPoint(BaseModel):
@@ -19,16 +22,35 @@ class EndPoint(BaseModel):
 
 
 @click.group()
-def cli():
+@click.option('--tenant', default='default', help="tenant whose mappings the command acts on;default: default")
+def cli(tenant):
     """python nat command line"""
-    pass
+    api.params['tenant'] = tenant
 
 
 @click.command('add')
 @click.argument('endpoint')
 @click.option('--bind-port', default=0, type=int, help="proxy server port bind;default: 0")
 @click.option('--same-port/--no-same-port', help="proxy server port mapping endpoint port same;default no-same-port")
-def add_nat_mapping(endpoint, bind_port, same_port):
+@click.option('--coalesce/--no-coalesce', default=Settings.forward_coalesce,
+              help="merge small writes into fewer frames;default from settings")
+@click.option('--coalesce-delay', default=Settings.forward_coalesce_delay, type=int,
+              help="microseconds a small write waits for more data")
+@click.option('--coalesce-bytes', default=Settings.forward_coalesce_bytes, type=int,
+              help="bytes that flush a coalesced frame at once")
+@click.option('--compression', default=Settings.compression or 'none',
+              help="codec for tunnel traffic e.g: zlib, none to disable;default from settings")
+@click.option('--rate-in', default=0, type=int, help="bytes/s from the users of the mapping;default 0 no limit")
+@click.option('--rate-out', default=0, type=int, help="bytes/s to the users of the mapping;default 0 no limit")
+@click.option('--rate-burst', default=0, type=int, help="bytes allowed above the rates;default one second of rate")
+@click.option('--max-connections', default=0, type=int, help="concurrent connections;default 0 no limit")
+@click.option('--priority', default=0, type=int, help="higher gets relays first when none is idle;default 0")
+@click.option('--acquire-timeout', default=0, type=float,
+              help="seconds a connection waits for a relay before it is closed;default 0 no limit")
+@click.option('--warm-tunnels', default=0, type=int,
+              help="relays kept with the local connection already open;default 0")
+def add_nat_mapping(endpoint, bind_port, same_port, coalesce, coalesce_delay, coalesce_bytes, compression,
+                    rate_in, rate_out, rate_burst, max_connections, priority, acquire_timeout, warm_tunnels):
     """add nat mapping with endpoint e.g: add 127.0.0.1:8888 """
     if same_port and bind_port != 0:
         click.echo('you can only use option one of (bind-port/same-port)')
@@ -41,7 +63,21 @@ def add_nat_mapping(endpoint, bind_port, same_port):
     except ValidationError:
         click.echo(f'({endpoint}) is error endpoint!!')
         return
-    response = requests.post(f'{BASE_URL}/endpoint/manager/add/', json={'bind_port': bind_port, **endpoint.dict()})
+    options = {
+        'coalesce': coalesce,
+        'coalesce_delay': coalesce_delay,
+        'coalesce_bytes': coalesce_bytes,
+        'compression': None if compression == 'none' else compression,
+        'rate_in': rate_in,
+        'rate_out': rate_out,
+        'rate_burst': rate_burst,
+        'max_connections': max_connections,
+        'priority': priority,
+        'acquire_timeout': acquire_timeout,
+        'warm_tunnels': warm_tunnels,
+    }
+    response = api.post(f'{BASE_URL}/endpoint/manager/add/',
+                             json={'bind_port': bind_port, 'options': options, **endpoint.dict()})
     click.echo(response.text)
 
 
@@ -49,38 +85,85 @@ def add_nat_mapping(endpoint, bind_port, same_port):
 @click.argument('server_id')
 def rm_nat_mapping(server_id):
     """rm nat mapping with log id e.g: rm 1 """
-    response = requests.post(f'{BASE_URL}/endpoint/manager/remove/?server_id={server_id}')
+    response = api.post(f'{BASE_URL}/endpoint/manager/remove/?server_id={server_id}')
+    click.echo(response.text)
+
+
+@click.command('set')
+@click.argument('server_id')
+@click.option('--coalesce/--no-coalesce', default=None, help="merge small writes into fewer frames")
+@click.option('--coalesce-delay', type=int, help="microseconds a small write waits for more data")
+@click.option('--coalesce-bytes', type=int, help="bytes that flush a coalesced frame at once")
+@click.option('--compression', help="codec for tunnel traffic e.g: zlib, none to disable")
+@click.option('--rate-in', type=int, help="bytes/s from the users of the mapping, 0 for no limit")
+@click.option('--rate-out', type=int, help="bytes/s to the users of the mapping, 0 for no limit")
+@click.option('--rate-burst', type=int, help="bytes allowed above the rates, 0 for one second of rate")
+@click.option('--max-connections', type=int, help="concurrent connections, 0 for no limit")
+@click.option('--priority', type=int, help="higher gets relays first when none is idle")
+@click.option('--acquire-timeout', type=float, help="seconds a connection waits for a relay, 0 for no limit")
+@click.option('--warm-tunnels', type=int, help="relays kept with the local connection already open")
+def set_nat_mapping(server_id, **options):
+    """change options of a nat mapping e.g: set 1 --rate-out 1048576, rates apply to open connections too """
+    options = {k: v for k, v in options.items() if v is not None}
+    if options.get('compression') == 'none':
+        options['compression'] = None
+    response = api.post(f'{BASE_URL}/endpoint/manager/options/?server_id={server_id}', json=options)
     click.echo(response.text)
 
 
 @click.command('ls')
 def list_nat_mapping():
     """list nat mapping"""
-    response = requests.get(f'{BASE_URL}/endpoint/manager/list/').json()
+    response = api.get(f'{BASE_URL}/endpoint/manager/list/').json()
     for server in response:
         click.echo(server)
 
 
+@click.command('metrics')
+def show_metrics():
+    """show traffic, latency and relay pool metrics"""
+    response = api.get(f'{BASE_URL}/endpoint/manager/metrics/')
+    click.echo(json.dumps(response.json(), indent=2))
+
+
+@click.command('tenants')
+def list_tenants():
+    """list tenants with their agents, mappings and idle relays"""
+    response = api.get(f'{BASE_URL}/endpoint/manager/tenants/').json()
+    for tenant in response:
+        click.echo(tenant)
+
+
 @click.command('watch')
 def watch_nat_status():
+    """watch relay pool size, active connections and throughput of every mapping, refreshed by the server"""
     import asyncio
     import websockets
 
-    # 客户端主逻辑
     async def main_logic():
         async with websockets.connect(f'ws://{Settings.http_command_host}:{Settings.http_command_port}'
-                                      f'/watching') as websocket:
+                                      f'/watching?tenant={api.params["tenant"]}') as websocket:
             while True:
-                response_str = await websocket.recv()
-                # print(response_str)
-                print('\r' + response_str, end='', flush=True)
+                snapshot = json.loads(await websocket.recv())
+                lines = [
+                    f'pool {snapshot["pool_size"]}  agents {snapshot["agents"]}',
+                    f'{"id":<6}{"endpoint":<24}{"active":>8}{"in KB/s":>12}{"out KB/s":>12}',
+                ]
+                for mapping in snapshot['mappings']:
+                    lines.append(f'{mapping["id"]:<6}{mapping["endpoint"]:<24}{mapping["active"]:>8}'
+                                 f'{mapping["in_bytes_per_s"] / 1024:>12.1f}{mapping["out_bytes_per_s"] / 1024:>12.1f}')
+                click.clear()
+                click.echo('\n'.join(lines))
 
-    asyncio.get_event_loop().run_until_complete(main_logic())
+    asyncio.run(main_logic())
 
 
 cli.add_command(add_nat_mapping)
 cli.add_command(rm_nat_mapping)
+cli.add_command(set_nat_mapping)
 cli.add_command(list_nat_mapping)
+cli.add_command(show_metrics)
+cli.add_command(list_tenants)
 cli.add_command(watch_nat_status)
 
 if __name__ == '__main__':
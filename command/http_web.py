@@ -1,11 +1,15 @@
 import asyncio
 from asyncio import Event
+from typing import Dict, Any, Optional, Tuple
 
-from fastapi import FastAPI, WebSocket, APIRouter, Request, Depends, Body, WebSocketDisconnect
+from fastapi import FastAPI, WebSocket, APIRouter, Request, Depends, Body, WebSocketDisconnect, HTTPException
 
 from server.proxy_server import ProxyServerFactory, ProxyServer, RelayPool
-from server.relay_server import RelayServer
 from server.manager_server import ManagerServer
+from settings import Settings
+from server.tenants import Tenant, TenantRegistry, DEFAULT_TENANT, tenant_ids
+from mapping import MappingOptions
+from metrics import Histogram
 
 endpoint_manager_router = APIRouter(prefix='/endpoint/manager')
 
@@ -13,16 +17,33 @@ endpoint_manager_router = APIRouter(prefix='/endpoint/manager')
 app = FastAPI()
 
 
-def get_proxy_server_factory():
-    return getattr(app, 'proxy_server_factory', None)
+def get_tenants():
+    return getattr(app, 'tenants', None)
 
 
-def get_proxy_pool():
-    return getattr(app, 'proxy_pool', None)
+def get_tenant(tenant: str = DEFAULT_TENANT, tenants: TenantRegistry = Depends(get_tenants)) -> Tenant:
+    # every endpoint acts on the mappings of one tenant, ?tenant=<id>
+    found = tenants.get(tenant)
+    if found is None:
+        raise HTTPException(status_code=404, detail=f'unknown tenant {tenant}')
+    return found
 
 
-def get_relay_server():
-    return getattr(app, 'relay_server', None)
+async def get_watch_tenant(websocket: WebSocket, tenant: str = DEFAULT_TENANT,
+                           tenants: TenantRegistry = Depends(get_tenants)) -> Optional[Tenant]:
+    # a websocket is refused by closing it before accept, an HTTPException would end in a 500
+    found = tenants.get(tenant)
+    if found is None:
+        await websocket.close(code=1008)
+    return found
+
+
+def get_proxy_server_factory(tenant: Tenant = Depends(get_tenant)):
+    return tenant.proxy_server_factory
+
+
+def get_proxy_pool(tenant: Tenant = Depends(get_tenant)):
+    return tenant.pool
 
 
 def get_manager_server():
@@ -31,6 +52,7 @@ def get_manager_server():
 
 @endpoint_manager_router.post('/add/')
 async def endpoint_add(host: str = Body(...), port: int = Body(...), bind_port: int = Body(0),
+                       options: Optional[MappingOptions] = Body(None),
                        proxy_server_factory: ProxyServerFactory = Depends(get_proxy_server_factory)):
     endpoint = (host, port)
     server = proxy_server_factory.servers.get(endpoint, 0)
@@ -38,7 +60,7 @@ async def endpoint_add(host: str = Body(...), port: int = Body(...), bind_port:
         return f"warning: {'%s:%s' % endpoint} is creating"
     elif server == 0:
         try:
-            server = await proxy_server_factory.create_server(endpoint, bind_port)
+            server = await proxy_server_factory.create_server(endpoint, bind_port, options)
         except Exception as e:
             return f"error: {'%s:%s' % endpoint} create fail: {e}"
         return f"success: {'%s:%s' % endpoint} --> {'%s:%s' % server.bind } created"
@@ -57,6 +79,20 @@ async def endpoint_remove(server_id: int,
         return f"success: server(id={server_id})@{'%s:%s' % server.endpoint} remove done"
 
 
+@endpoint_manager_router.post('/options/')
+async def endpoint_options(server_id: int, options: Dict[str, Any] = Body(...),
+                           proxy_server_factory: ProxyServerFactory = Depends(get_proxy_server_factory)):
+    server = proxy_server_factory.get_server_by_id(server_id)
+    if server is None:
+        return f"warning: server(id={server_id}) not exist"
+    try:
+        options = MappingOptions(**{**server.options.dict(), **options})
+        proxy_server_factory.update_options(server, options)
+    except ValueError as e:
+        return f"error: server(id={server_id}) invalid options: {e}"
+    return f"success: server(id={server_id}) options {server.options.dict()}"
+
+
 @endpoint_manager_router.get('/list/')
 async def endpoint_list(proxy_server_factory: ProxyServerFactory = Depends(get_proxy_server_factory)):
     server_list = list(proxy_server_factory.servers.values())
@@ -68,32 +104,113 @@ async def endpoint_list(proxy_server_factory: ProxyServerFactory = Depends(get_p
             'server':  server.bind,
             'endpoint': '%s:%s' % server.endpoint,
             'create_at': server.create_at,
+            'options': server.options.dict(),
+            'stats': server.stats.dict(),
         }
         for server in server_list
     ]
 
 
+@endpoint_manager_router.get('/metrics/')
+async def endpoint_metrics(proxy_server_factory: ProxyServerFactory = Depends(get_proxy_server_factory),
+                           pool: RelayPool = Depends(get_proxy_pool),
+                           tenant: Tenant = Depends(get_tenant),
+                           manager_server: ManagerServer = Depends(get_manager_server)):
+    agents = list(tenant.broadcaster.agents.values())
+    # local connect times reported by every agent, merged per endpoint
+    connect_times: Dict[str, Histogram] = {}
+    for agent in agents:
+        for endpoint, histogram in agent.connect_times.items():
+            if endpoint in connect_times:
+                connect_times[endpoint].merge(histogram)
+            else:
+                connect_times[endpoint] = Histogram.from_dict(histogram)
+    server_list = [server for server in proxy_server_factory.servers.values() if server is not None]
+    server_list.sort(key=lambda x: x.server_id)
+    return {
+        'manager': {
+            'connected': bool(agents),
+            'epoch': manager_server.epoch,
+            'agents': [{'agent_id': agent.agent_id, **agent.load.dict(), 'relay_dials': agent.relay_dials}
+                       for agent in agents],
+        },
+        'pool': pool.stats(),
+        'mappings': [
+            {
+                'id': server.server_id,
+                'endpoint': '%s:%s' % server.endpoint,
+                **server.stats.dict(),
+                'local_connect': connect_times['%s:%s' % server.endpoint].dict()
+                if '%s:%s' % server.endpoint in connect_times else None,
+            }
+            for server in server_list
+        ]
+    }
+
+
+@endpoint_manager_router.get('/tenants/')
+async def endpoint_tenants(tenants: TenantRegistry = Depends(get_tenants)):
+    return [
+        {
+            'tenant': tenant.tenant_id,
+            'agents': len(tenant.broadcaster.agents),
+            'mappings': sum(server is not None for server in tenant.proxy_server_factory.servers.values()),
+            'pool_size': tenant.pool.qsize(),
+        }
+        for tenant in map(tenants.get, sorted(tenant_ids()))
+    ]
+
+
+def watch_snapshot(tenant: Tenant, last: Dict[int, Tuple[int, int]], elapsed: float) -> Dict[str, Any]:
+    # throughput is over the elapsed seconds since the subscriber's previous snapshot, last holds its byte counts
+    server_list = [server for server in tenant.proxy_server_factory.servers.values() if server is not None]
+    server_list.sort(key=lambda x: x.server_id)
+    mappings = []
+    for server in server_list:
+        counts = (server.stats.bytes_in, server.stats.bytes_out)
+        previous = last.get(server.server_id, counts)
+        last[server.server_id] = counts
+        mappings.append({
+            'id': server.server_id,
+            'endpoint': '%s:%s' % server.endpoint,
+            'active': server.stats.active,
+            'in_bytes_per_s': round((counts[0] - previous[0]) / elapsed),
+            'out_bytes_per_s': round((counts[1] - previous[1]) / elapsed),
+        })
+    return {
+        'pool_size': tenant.pool.qsize(),
+        'agents': len(tenant.broadcaster.agents),
+        'mappings': mappings,
+    }
+
+
 @endpoint_manager_router.websocket('/watching')
-async def endpoint_watching(
-        websocket: WebSocket,
-        pool: RelayPool = Depends(get_proxy_pool),
-        relay_server: RelayServer = Depends(get_relay_server),
-        manager_server: ManagerServer = Depends(get_manager_server)
-):
+async def endpoint_watching(websocket: WebSocket, tenant: Optional[Tenant] = Depends(get_watch_tenant)):
+    if tenant is None:
+        return
     await websocket.accept()
 
-    def pool_watcher(event):
+    async def publish():
+        # one snapshot per watch_interval, sent only once the previous one went out: a slow subscriber
+        # skips the states in between instead of queueing them
         loop = asyncio.get_event_loop()
-        loop.create_task(
-            websocket.send_json({'pool_size_change': pool.qsize()})
-        )
-    pool.add_watcher(pool_watcher)
-    while True:
-        message = await websocket.receive()
-        message_type = message["type"]
-        if message_type == "websocket.disconnect":
-            break
-    pool.remove_watcher(pool_watcher)
+        last: Dict[int, Tuple[int, int]] = {}
+        sent_at = loop.time()
+        while True:
+            await asyncio.sleep(Settings.watch_interval)
+            now = loop.time()
+            snapshot = watch_snapshot(tenant, last, now - sent_at)
+            sent_at = now
+            await websocket.send_json(snapshot)
+
+    publisher = asyncio.get_event_loop().create_task(publish())
+    try:
+        while not publisher.done():
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+    finally:
+        publisher.cancel()
 
 
 app.include_router(endpoint_manager_router)
@@ -0,0 +1,144 @@
+import zlib
+import asyncio
+import functools
+from collections import deque
+from asyncio.futures import Future
+from typing import Optional, Dict, Callable, Deque, List
+
+from settings import Settings
+
+
+class Codec(object):
+    # a codec compresses one direction of a tunnel as a stream: every compress() output can be
+    # decompressed on its own by the peer's decompressor, given it saw all earlier outputs in order
+    name = ''
+
+    def compressor(self, level: Optional[int] = None):
+        raise NotImplementedError
+
+    def decompressor(self):
+        raise NotImplementedError
+
+
+class ZlibCompressor(object):
+    def __init__(self, level: int):
+        self.compressobj = zlib.compressobj(level)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressobj.compress(data) + self.compressobj.flush(zlib.Z_SYNC_FLUSH)
+
+
+class ZlibDecompressor(object):
+    def __init__(self):
+        self.decompressobj = zlib.decompressobj()
+
+    def decompress(self, data: bytes) -> bytes:
+        return self.decompressobj.decompress(data)
+
+
+class ZlibCodec(Codec):
+    name = 'zlib'
+
+    def compressor(self, level: Optional[int] = None) -> ZlibCompressor:
+        return ZlibCompressor(Settings.compression_level if level is None else level)
+
+    def decompressor(self) -> ZlibDecompressor:
+        return ZlibDecompressor()
+
+
+CODECS: Dict[str, Codec] = {}
+
+
+def register_codec(codec: Codec):
+    CODECS[codec.name] = codec
+
+
+register_codec(ZlibCodec())
+
+
+def negotiate_codec(name: Optional[str], offered: List[str]) -> Optional[str]:
+    if name and name in CODECS and name in offered:
+        return name
+    return None
+
+
+class ForwardCompressor(object):
+    # compresses the Forward bodies of one tunnel direction into emit(data, compressed, uncompressed size),
+    # large chunks are compressed in a worker thread while later chunks wait in order behind them
+    def __init__(self, codec: Optional[str], emit: Callable[[bytes, bool, int], None],
+                 on_busy: Callable[[bool], None], stats=None):
+        self.compressor = CODECS[codec].compressor() if codec else None
+        self.emit = emit
+        self.on_busy = on_busy
+        self.stats = stats
+        self.queue: Deque[bytes] = deque()
+        self.busy = False
+        self.paused = False
+        self.closed = False
+        self.finish_callback: Optional[Callable[[], None]] = None
+        # raw and compressed bytes since the ratio was last checked
+        self.sample_raw = 0
+        self.sample_compressed = 0
+        # bytes still sent uncompressed after a poor ratio was observed
+        self.bypass = 0
+
+    def write(self, data: bytes):
+        if self.busy:
+            self.queue.append(data)
+        else:
+            self.process(data)
+
+    def process(self, data: bytes):
+        if self.compressor is None or self.bypass > 0 or len(data) < Settings.compression_min_bytes:
+            self.bypass -= len(data)
+            self.emit(data, False, len(data))
+        elif len(data) >= Settings.compression_offload_bytes:
+            self.busy = True
+            if not self.paused:
+                self.paused = True
+                self.on_busy(True)
+            future = asyncio.get_event_loop().run_in_executor(None, self.compressor.compress, data)
+            future.add_done_callback(functools.partial(self.on_compressed, data))
+        else:
+            self.compressed(data, self.compressor.compress(data))
+
+    def compressed(self, data: bytes, compressed: bytes):
+        self.emit(compressed, True, len(data))
+        self.sample_raw += len(data)
+        self.sample_compressed += len(compressed)
+        if self.stats:
+            self.stats.compress_raw_bytes += len(data)
+            self.stats.compress_wire_bytes += len(compressed)
+        if self.sample_raw < Settings.compression_sample_bytes:
+            return
+        if self.sample_compressed > self.sample_raw * Settings.compression_min_ratio:
+            self.bypass = Settings.compression_bypass_bytes
+        self.sample_raw = self.sample_compressed = 0
+
+    def on_compressed(self, data: bytes, future: Future):
+        if self.closed:
+            return
+        self.busy = False
+        self.compressed(data, future.result())
+        while self.queue and not self.busy:
+            self.process(self.queue.popleft())
+        if self.busy:
+            return
+        if self.paused:
+            self.paused = False
+            self.on_busy(False)
+        if self.finish_callback:
+            callback, self.finish_callback = self.finish_callback, None
+            callback()
+
+    def finish(self, callback: Callable[[], None]):
+        # run callback once every chunk written so far has been emitted
+        if self.busy:
+            self.finish_callback = callback
+        else:
+            callback()
+
+    def discard(self):
+        self.closed = True
+        self.queue.clear()
+        self.finish_callback = None
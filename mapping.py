@@ -0,0 +1,129 @@
+import math
+from typing import Dict, Any, Optional, Iterable
+
+from pydantic import BaseModel, validator
+
+from settings import Settings
+from compression import CODECS
+from metrics import Histogram
+
+
+class MappingOptions(BaseModel):
+    # merge small writes into fewer Forward frames, latency-sensitive mappings keep it off
+    coalesce: bool = Settings.forward_coalesce
+    coalesce_delay: int = Settings.forward_coalesce_delay
+    coalesce_bytes: int = Settings.forward_coalesce_bytes
+    # codec for Forward bodies, used when the client supports it too
+    compression: Optional[str] = Settings.compression
+    # bandwidth limits in bytes/s from (in) and to (out) the users of the mapping, over all its connections,
+    # and the burst allowed above them, 0 for none
+    rate_in: int = 0
+    rate_out: int = 0
+    rate_burst: int = 0
+    # concurrent connections, more are closed right after accept, 0 for no limit
+    max_connections: int = 0
+    # with no idle relay, connections of higher priority mappings get the next one first
+    priority: int = 0
+    # seconds a connection waits for a relay before it is closed, 0 for no limit
+    acquire_timeout: float = 0
+    # relays kept bound to the endpoint with the local connection already open on the client,
+    # new connections take one of them before going to the pool
+    warm_tunnels: int = 0
+
+    @validator('compression')
+    def check_compression(cls, v):
+        if v and v not in CODECS:
+            raise ValueError(f'unknown codec {v}, available: {", ".join(CODECS)}')
+        return v or None
+
+    @validator('rate_in', 'rate_out', 'rate_burst', 'max_connections', 'acquire_timeout', 'warm_tunnels')
+    def check_limit(cls, v):
+        if v < 0:
+            raise ValueError('must be 0 (no limit) or positive')
+        return v
+
+    def share(self, parts: int, index: int) -> 'MappingOptions':
+        # the limits worker index of parts enforces for its part of the connections: counts are split exactly,
+        # the remainder going to worker 0, rates are split evenly so one connection gets rate / parts
+        update = {name: math.ceil(getattr(self, name) / parts) for name in ('rate_in', 'rate_out', 'rate_burst')}
+        for name in ('max_connections', 'warm_tunnels'):
+            value = getattr(self, name)
+            update[name] = value // parts + (value % parts if index == 0 else 0)
+        return self.copy(update=update)
+
+    def to_headers(self) -> Dict[str, Any]:
+        # options the client needs for its direction of the tunnel, sent with NewTunnel
+        headers = {}
+        if self.coalesce:
+            headers['Coalesce'] = f'{self.coalesce_delay},{self.coalesce_bytes}'
+        return headers
+
+    @classmethod
+    def from_headers(cls, headers: Dict[str, Any]) -> 'MappingOptions':
+        options = {}
+        if 'Coalesce' in headers:
+            delay, size = headers['Coalesce'].split(',')
+            options.update(coalesce=True, coalesce_delay=int(delay), coalesce_bytes=int(size))
+        else:
+            options['coalesce'] = False
+        # the server only names a codec it negotiated, one we offered
+        options['compression'] = headers.get('Compression')
+        return cls(**options)
+
+
+class MappingStats(object):
+    def __init__(self):
+        self.active = 0
+        self.accepts = 0
+        self.rejected = 0  # over max_connections
+        self.bytes_in = 0  # from the users of the mapping
+        self.bytes_out = 0  # to the users of the mapping
+        self.acquire_wait = Histogram()  # seconds an accepted connection waited for a relay
+        self.acquire_timeouts = 0  # connections closed after acquire_timeout without a relay
+        self.parked = 0  # connections waiting for a client agent to reconnect
+        self.park_overflows = 0  # refused while reconnect_park_max connections were parked
+        self.park_timeouts = 0  # closed after reconnect_grace without an agent
+        self.warm_hits = 0  # connections spliced onto a warm tunnel
+        self.warm_refreshes = 0  # warm tunnels replaced after warm_tunnel_max_age
+        self.forward_writes = 0
+        self.forward_frames = 0
+        self.compress_raw_bytes = 0
+        self.compress_wire_bytes = 0
+
+    @classmethod
+    def merge(cls, reports: Iterable[Dict[str, int]]) -> 'MappingStats':
+        # sum of the counters reported by several worker processes
+        stats = cls()
+        for report in reports:
+            for name, value in vars(stats).items():
+                if isinstance(value, Histogram):
+                    if name in report:
+                        value.merge(report[name])
+                else:
+                    setattr(stats, name, value + report.get(name, 0))
+        return stats
+
+    @property
+    def frames_saved(self) -> int:
+        return self.forward_writes - self.forward_frames
+
+    def dict(self) -> Dict[str, Any]:
+        return {
+            'active': self.active,
+            'accepts': self.accepts,
+            'rejected': self.rejected,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'acquire_wait': self.acquire_wait.dict(),
+            'acquire_timeouts': self.acquire_timeouts,
+            'parked': self.parked,
+            'park_overflows': self.park_overflows,
+            'park_timeouts': self.park_timeouts,
+            'warm_hits': self.warm_hits,
+            'warm_refreshes': self.warm_refreshes,
+            'forward_writes': self.forward_writes,
+            'forward_frames': self.forward_frames,
+            'frames_saved': self.frames_saved,
+            'compress_raw_bytes': self.compress_raw_bytes,
+            'compress_wire_bytes': self.compress_wire_bytes,
+        }
@@ -0,0 +1,55 @@
+from bisect import bisect_left
+from typing import Dict, Any, List, Optional, Tuple
+
+# upper bounds in seconds, a last bucket counts everything slower
+LATENCY_BOUNDS: Tuple[float, ...] = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+
+
+class Histogram(object):
+    # fixed buckets, observe() is a bisect and two additions so it can stay on in the hot path
+    def __init__(self, bounds: Tuple[float, ...] = LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.counts: List[int] = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def quantile(self, q: float) -> Optional[float]:
+        # upper bound of the bucket holding the q quantile, None for the overflow bucket or no data
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return None
+
+    def merge(self, other: Dict[str, Any]):
+        # add a histogram reported as dict() by another process
+        for i, count in enumerate(other['counts']):
+            self.counts[i] += count
+        self.sum += other['sum']
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'Histogram':
+        histogram = cls(tuple(data['bounds']))
+        histogram.merge(data)
+        return histogram
+
+    def dict(self) -> Dict[str, Any]:
+        return {
+            'bounds': list(self.bounds),
+            'counts': list(self.counts),
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+        }
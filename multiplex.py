@@ -0,0 +1,239 @@
+from collections import deque
+from typing import Optional, Dict, Any, Callable, Deque, Tuple, Union
+
+from settings import Settings
+from protocols import ImitateHttpProtocol, CommandEnum, FRAME_FLAG_COMPRESSED
+from tunnel import Tunnel, TunnelPoint, ForwardCoalescer
+from compression import CODECS, ForwardCompressor
+
+
+class MultiplexStream(TunnelPoint):
+    def __init__(self, multiplexer: 'Multiplexer', stream_id: int, window: Optional[int] = None):
+        self.multiplexer = multiplexer
+        self.stream_id = stream_id
+        self.window = window or Settings.multiplex_window
+        # bytes the peer still accepts from us, refilled by WindowUpdate
+        self.send_window = self.window
+        # (data, frame flags, window cost) waiting for window, the window counts uncompressed bytes
+        self.send_pending: Deque[Tuple[bytes, int, int]] = deque()
+        # our source is paused while the window is exhausted, the shared relay transport is full
+        # or a large chunk is being compressed
+        self.window_paused = False
+        self.relay_paused = multiplexer.paused
+        self.compress_paused = False
+        self.source_paused = False
+        # bytes delivered to our side of the tunnel but not yet credited back to the peer,
+        # withheld while our side cannot take more so the peer runs out of window
+        self.recv_unacked = 0
+        self.recv_paused = False
+        self.closing = False
+        self.closed = False
+        self.coalescer: Optional[ForwardCoalescer] = None
+        self.compressor: Optional[ForwardCompressor] = None
+        self.codec: Optional[str] = None
+        self.decompressor = None
+        self.receive_compressed = False
+
+    def send(self, command: CommandEnum, headers: Optional[Dict[str, Any]] = None, body: bytes = b'',
+             flags: int = 0):
+        # streams share the relay, frames they send within one loop iteration are written together
+        self.multiplexer.relay.cork()
+        self.multiplexer.relay.send(command, headers, body, stream_id=self.stream_id, flags=flags)
+
+    def set_codec(self, codec: Optional[str]):
+        self.codec = codec
+        self.decompressor = CODECS[codec].decompressor() if codec else None
+
+    def on_tunnel_build(self, tunnel: Tunnel):
+        super().on_tunnel_build(tunnel)
+        self.compressor = ForwardCompressor(self.codec, self.write_forward, self.on_compress_busy, tunnel.stats)
+        self.coalescer = ForwardCoalescer(self.compressor.write, tunnel.options, tunnel.stats)
+        # pauses requested before the tunnel existed had nothing to act on
+        self.source_paused = False
+        self.update_source()
+
+    def update_source(self):
+        paused = self.window_paused or self.relay_paused or self.compress_paused
+        if paused == self.source_paused:
+            return
+        self.source_paused = paused
+        if paused:
+            self.tunnel.pause(self)
+        else:
+            self.tunnel.resume(self)
+
+    def on_relay_pause(self):
+        self.relay_paused = True
+        self.update_source()
+
+    def on_relay_resume(self):
+        self.relay_paused = False
+        self.update_source()
+
+    def on_compress_busy(self, busy: bool):
+        self.compress_paused = busy
+        self.update_source()
+
+    def on_tunnel_write(self, data: bytes):
+        self.coalescer.write(data)
+
+    def write_forward(self, data: bytes, compressed: bool = False, size: Optional[int] = None):
+        if self.closed:
+            return
+        flags = FRAME_FLAG_COMPRESSED if compressed else 0
+        cost = len(data) if size is None else size
+        if not self.send_pending and cost <= self.send_window:
+            self.send_window -= cost
+            self.send(CommandEnum.Forward, body=data, flags=flags)
+            return
+        self.send_pending.append((data, flags, cost))
+        self.flush_pending()
+
+    def flush_pending(self):
+        while self.send_pending and self.send_window > 0:
+            data, flags, cost = self.send_pending.popleft()
+            # a compressed chunk goes out whole, the peer may not decompress anything from a part
+            # of it and would never credit the rest; the window overshoots by at most one chunk
+            if cost > self.send_window and not flags & FRAME_FLAG_COMPRESSED:
+                self.send_pending.appendleft((data[self.send_window:], flags, cost - self.send_window))
+                data, cost = data[:self.send_window], self.send_window
+            self.send_window -= cost
+            self.send(CommandEnum.Forward, body=data, flags=flags)
+
+        self.window_paused = bool(self.send_pending)
+        self.update_source()
+        if self.send_pending:
+            return
+        if self.closing:
+            self.finish_close()
+
+    def on_window_update(self, increment: int):
+        self.send_window += increment
+        self.flush_pending()
+
+    def feed(self, body: memoryview):
+        self.deliver(self.decode(body))
+
+    def decode(self, body: memoryview) -> Union[bytes, memoryview]:
+        if self.receive_compressed:
+            return self.decompressor.decompress(body)
+        return body
+
+    def deliver(self, data: Union[bytes, memoryview]):
+        self.tunnel.write(self, data)
+        self.recv_unacked += len(data)
+        self.credit()
+
+    def credit(self):
+        if self.recv_paused or self.closed or self.recv_unacked < self.window // 2:
+            return
+        self.send(CommandEnum.WindowUpdate, headers={'Increment': self.recv_unacked})
+        self.recv_unacked = 0
+
+    def on_tunnel_pause(self):
+        self.recv_paused = True
+
+    def on_tunnel_resume(self):
+        self.recv_paused = False
+        self.credit()
+
+    def on_tunnel_close(self, exc: Optional[Exception]):
+        # our side is done: flush what the coalescer, compressor and window still hold back,
+        # then end the stream in-band
+        if self.coalescer:
+            self.coalescer.flush()
+            self.compressor.finish(self.close_when_sent)
+        else:
+            self.close_when_sent()
+
+    def close_when_sent(self):
+        self.closing = True
+        if not self.send_pending:
+            self.finish_close()
+
+    def finish_close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.send(CommandEnum.CloseTunnel)
+        self.multiplexer.discard(self)
+
+    def remote_close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.send_pending.clear()
+        if self.coalescer:
+            self.coalescer.discard()
+            self.compressor.discard()
+        self.multiplexer.discard(self)
+        self.tunnel.close(self)
+
+    def relay_lost(self, exc: Optional[Exception]):
+        self.closed = True
+        self.send_pending.clear()
+        if self.coalescer:
+            self.coalescer.discard()
+            self.compressor.discard()
+        self.tunnel.close(self, exc)
+
+    def on_new_tunnel(self, headers: Dict[str, Any]):
+        pass
+
+
+class Multiplexer(object):
+    def __init__(self, relay: ImitateHttpProtocol, stream_factory: Callable[..., MultiplexStream]):
+        self.relay = relay
+        self.stream_factory = stream_factory
+        self.streams: Dict[int, MultiplexStream] = {}
+        self.receiving: Optional[MultiplexStream] = None
+        self.last_stream_id = 0
+        self.paused = False
+
+    def open_stream(self) -> MultiplexStream:
+        self.last_stream_id += 1
+        stream = self.stream_factory(self, self.last_stream_id)
+        self.streams[stream.stream_id] = stream
+        return stream
+
+    def discard(self, stream: MultiplexStream):
+        if self.streams.pop(stream.stream_id, None) is not None:
+            self.relay.on_stream_close(stream)
+
+    def command_complete(self, command: CommandEnum, headers: Dict[str, Any]):
+        stream_id = int(headers['StreamId'])
+        stream = self.streams.get(stream_id)
+        self.receiving = None
+        if command == CommandEnum.NewTunnel:
+            assert stream is None, f'repeat stream id {stream_id}'
+            stream = self.stream_factory(self, stream_id, int(headers['Window']))
+            self.streams[stream_id] = stream
+            stream.on_new_tunnel(headers)
+        elif stream is None:  # late frame of a stream closed on our side
+            return
+        elif command == CommandEnum.Forward:
+            self.receiving = stream
+            stream.receive_compressed = 'Compressed' in headers
+        elif command == CommandEnum.WindowUpdate:
+            stream.on_window_update(int(headers['Increment']))
+        elif command == CommandEnum.CloseTunnel:
+            stream.remote_close()
+
+    def body_stream(self, body: memoryview):
+        if self.receiving:
+            self.receiving.feed(body)
+
+    def pause_streams(self):
+        self.paused = True
+        for stream in list(self.streams.values()):
+            stream.on_relay_pause()
+
+    def resume_streams(self):
+        self.paused = False
+        for stream in list(self.streams.values()):
+            stream.on_relay_resume()
+
+    def close(self, exc: Optional[Exception] = None):
+        streams, self.streams = self.streams, {}
+        for stream in streams.values():
+            stream.relay_lost(exc)
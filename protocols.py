@@ -1,10 +1,10 @@
-from io import BytesIO
 import enum
-from typing import Optional, NoReturn, Tuple, Dict, Any
+import struct
+import contextlib
+from typing import Optional, NoReturn, Tuple, Dict, Any, Union, List
 import asyncio
 from asyncio.futures import Future
-from asyncio import Protocol
-from asyncio.selector_events import _SelectorSocketTransport
+from asyncio import Protocol, BufferedProtocol
 
 from loguru import logger
 
@@ -22,6 +22,83 @@ class CommandEnum(str, enum.Enum):
     AuthSuccess = 'AuthSuccess'
     ManagerEpochChange = 'ManagerEpochChange'
     ManagerKickOut = 'ManagerKickOut'
+    WindowUpdate = 'WindowUpdate'
+    ClientMetrics = 'ClientMetrics'
+    TunnelReady = 'TunnelReady'
+    TunnelActivate = 'TunnelActivate'
+    TunnelRaw = 'TunnelRaw'
+
+
+# binary command codes are part of the wire format, append new commands only
+COMMAND_CODES: Dict[CommandEnum, int] = {command: code for code, command in enumerate(CommandEnum, 1)}
+CODE_COMMANDS: Dict[int, CommandEnum] = {code: command for command, code in COMMAND_CODES.items()}
+
+
+class FramingEnum(str, enum.Enum):
+    text = 'text'
+    binary = 'binary'
+
+
+# binary frame: magic | command code | flags | header block length | body length
+BINARY_FRAME_MAGIC = 0xFB
+BINARY_FRAME_HEADER = struct.Struct('!BBBHI')
+# flag: a stream id follows the fixed header (multiplexed relay)
+FRAME_FLAG_STREAM = 0x01
+# flag: the body is compressed with the codec negotiated for the tunnel, text framing sends `Compressed: 1`
+FRAME_FLAG_COMPRESSED = 0x02
+FRAME_STREAM_ID = struct.Struct('!I')
+
+
+def encode_header_block(headers: Optional[Dict[str, Any]]) -> bytes:
+    if not headers:
+        return b''
+    return ''.join(f'{hk}: {hv}\n' for hk, hv in headers.items()).encode()
+
+
+def decode_header_block(block: bytes) -> Dict[str, Any]:
+    headers = {}
+    for line in block.decode().splitlines():
+        header_k, header_v = line.split(':', 1)
+        headers[header_k] = header_v.strip()
+    return headers
+
+
+# the static part of a text frame header is encoded once per command, not for every frame
+TEXT_COMMAND_PREFIXES: Dict[CommandEnum, bytes] = {
+    command: f'Command: {command.value}\n'.encode() for command in CommandEnum
+}
+
+
+def pack_text_frame_header(command: CommandEnum, headers: Optional[Dict[str, Any]] = None, body_length: int = 0,
+                           stream_id: Optional[int] = None, flags: int = 0) -> bytes:
+    header = TEXT_COMMAND_PREFIXES[command]
+    if stream_id is not None:
+        header += b'StreamId: %d\n' % stream_id
+    if flags & FRAME_FLAG_COMPRESSED:
+        header += b'Compressed: 1\n'
+    if headers:
+        header += encode_header_block(headers)
+    if body_length:
+        return header + b'ContentLength: %d\n\n' % body_length
+    return header + b'\n'
+
+
+def pack_binary_frame_header(command: CommandEnum, headers: Optional[Dict[str, Any]] = None, body_length: int = 0,
+                             stream_id: Optional[int] = None, flags: int = 0) -> bytes:
+    header_block = encode_header_block(headers)
+    if stream_id is None:
+        return BINARY_FRAME_HEADER.pack(
+            BINARY_FRAME_MAGIC, COMMAND_CODES[command], flags, len(header_block), body_length
+        ) + header_block
+    return BINARY_FRAME_HEADER.pack(
+        BINARY_FRAME_MAGIC, COMMAND_CODES[command], flags | FRAME_FLAG_STREAM, len(header_block), body_length
+    ) + FRAME_STREAM_ID.pack(stream_id) + header_block
+
+
+FRAME_HEADER_PACKERS = {
+    FramingEnum.text: pack_text_frame_header,
+    FramingEnum.binary: pack_binary_frame_header,
+}
 
 
 class ProtocolAuthState(str, enum.Enum):
@@ -48,99 +125,224 @@ class BaseProtocol(Protocol):
         self._loop = asyncio.get_event_loop()
 
         # Per-connection state
-        self.transport: Optional[_SelectorSocketTransport] = None
+        self.transport: Optional[asyncio.Transport] = None
         self.server: Optional[Tuple[str, int]] = None
         self.client: Optional[Tuple[str, int]] = None
 
-    def connection_made(self, transport: _SelectorSocketTransport) -> NoReturn:
+    def connection_made(self, transport: asyncio.Transport) -> NoReturn:
         self.transport = transport
         self.server = get_local_addr(transport) or (None, None)
         self.client = get_remote_addr(transport) or (None, None)
+        transport.set_write_buffer_limits(high=Settings.write_buffer_high, low=Settings.write_buffer_low)
 
 
 class ForbiddenProtocol(Protocol):
-    def connection_made(self, transport: _SelectorSocketTransport):
+    def connection_made(self, transport: asyncio.Transport):
         transport.close()
 
 
-class ImitateHttpProtocol(BaseProtocol):
+class ImitateHttpProtocol(BaseProtocol, BufferedProtocol):
     def __init__(self):
         super().__init__()
         self.parser = ImitateHttpParser(self)
+        # outgoing wire format, switched to binary once the peer acknowledged it in AuthSuccess
+        self.framing = FramingEnum.text
+        # frames collected while corked, written with a single writelines call
+        self.write_batch: Optional[List[Union[bytes, memoryview]]] = None
+        # the peer sends unframed bytes from now on, they go to on_raw_data without parsing
+        self.raw = False
 
     def on_command_complete(self, command: CommandEnum, headers: Dict[str, Any]):
         pass
 
-    def on_body_stream(self, body: bytes):
+    def on_body_stream(self, body: memoryview):
+        # body is a view into the parser buffer, only valid during the call: copy it to keep it
+        pass
+
+    def on_raw_data(self, data: Union[bytes, memoryview]):
+        # like on_body_stream, a memoryview is only valid during the call
         pass
 
+    def switch_raw(self):
+        # called from the handler of the peer's last frame, the bytes following it are raw
+        self.raw = True
+        self.parser.switch_raw()
+
     def command_complete(self, command: CommandEnum, headers: Dict[str, Any]):
+        if command == CommandEnum.AuthSuccess and headers.get('Framing') == FramingEnum.binary:
+            self.framing = FramingEnum.binary
         self.on_command_complete(command, headers)
 
-    def body_stream(self, body: bytes):
+    def body_stream(self, body: memoryview):
         self.on_body_stream(body)
 
-    def data_received(self, data: bytes):
-        try:
-            self.parser.feed_data(data)
-        except ParserCallbackError:
-            raise
-        except ImitateHttpParserError as e:
-            msg = f"<{get_remote_addr(self.transport)}> Invalid HTTP request received: \n {e}"
-            logger.warning(msg)
-            self.transport.close()
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.parser.get_buffer(sizehint)
 
-    def send(self, command: CommandEnum, headers: Optional[Dict[str, Any]] = None, body: bytes = b''):
-        header_list = [f'Command: {command}']
-        if headers:
-            for hk, hv in headers.items():
-                header_list.append(f'{hk}: {hv}')
-        header_list.append('')
+    def buffer_updated(self, nbytes: int):
+        if self.raw:
+            self.on_raw_data(self.parser.take_raw(nbytes))
+        else:
+            self.parse(self.parser.buffer_updated, nbytes)
 
-        content_bytes = '\n'.join(header_list).encode()
-        if body:
-            content_bytes += b'ContentLength: %d\n\n%s' % (len(body), body)
+    def data_received(self, data: bytes):
+        if self.raw:
+            self.on_raw_data(data)
         else:
-            content_bytes += b'\n'
-        self.transport.write(content_bytes)
+            self.parse(self.parser.feed_data, data)
+
+    def parse(self, feed, data):
+        # replies triggered by the frames of one read go out together
+        with self.batch():
+            try:
+                feed(data)
+            except ParserCallbackError:
+                raise
+            except ImitateHttpParserError as e:
+                msg = f"<{get_remote_addr(self.transport)}> Invalid HTTP request received: \n {e}"
+                logger.warning(msg)
+                self.transport.close()
+
+    def send(self, command: CommandEnum, headers: Optional[Dict[str, Any]] = None, body: bytes = b'',
+             stream_id: Optional[int] = None, flags: int = 0):
+        if self.transport.is_closing():
+            # frames for a closed connection are dropped, uvloop raises where asyncio only logged
+            return
+        header = FRAME_HEADER_PACKERS[self.framing](command, headers, len(body), stream_id, flags)
+        if self.write_batch is not None:
+            self.write_batch.append(header)
+            if body:
+                self.write_batch.append(body)
+        elif body:
+            # header and body are handed over as separate buffers, the body is never copied into a frame
+            self.transport.writelines((header, body))
+        else:
+            self.transport.write(header)
+
+    def cork(self):
+        # hold frames until the end of this loop iteration, so frames of many streams share one syscall
+        if self.write_batch is None:
+            self.write_batch = []
+            self._loop.call_soon(self.uncork)
+
+    def uncork(self):
+        buffers, self.write_batch = self.write_batch, None
+        if buffers and not self.transport.is_closing():
+            self.transport.writelines(buffers)
+
+    def close(self):
+        # frames still held by a batch go out first, the transport writes its buffer before closing
+        self.uncork()
+        self.transport.close()
+
+    @contextlib.contextmanager
+    def batch(self):
+        if self.write_batch is not None:  # already corked, the outer batch flushes
+            yield
+            return
+        self.write_batch = []
+        try:
+            yield
+        finally:
+            self.uncork()
 
 
 class ImitateHttpParser(object):
     class ParseStateEnum(str, enum.Enum):
         header_parse = 'header_parse'
         body_stream = 'body_stream'
+        raw = 'raw'
+
+    # a header that does not fit in this many bytes is an error, not a reason to keep buffering
+    MaxHeaderSize = 64 * 1024
 
     def __init__(self, protocol: ImitateHttpProtocol):
         self.protocol = protocol
+        # unparsed bytes live in buffer[start:end], the event loop reads straight into buffer[end:]
+        self.buffer = bytearray(Settings.read_buffer_size)
+        self.start = 0
+        self.end = 0
         self.reset()
-        self.state = self.ParseStateEnum.header_parse
-        self.command = ''
-        self.headers = {}
-        self.unprocessed = b''
-        self.expected_body_length = 0
 
     def reset(self):
         self.state = self.ParseStateEnum.header_parse
         self.command = ''
         self.headers = {}
-        self.unprocessed = b''
         self.expected_body_length = 0
 
+    def get_buffer(self, sizehint: int = -1) -> memoryview:
+        self.make_room(len(self.buffer) // 4)
+        return memoryview(self.buffer)[self.end:]
+
+    def buffer_updated(self, nbytes: int):
+        self.end += nbytes
+        self.parse_buffer()
+
+    def switch_raw(self):
+        self.state = self.ParseStateEnum.raw
+
+    def take_raw(self, nbytes: int) -> memoryview:
+        # the read bytes are consumed as they are, the buffer is compacted by make_room like after a parse
+        start = self.end
+        self.start = self.end = start + nbytes
+        return memoryview(self.buffer)[start:self.end]
+
     def feed_data(self, data: bytes):
+        if self.start == self.end:
+            # nothing pending, parse the loop's bytes in place and keep only an incomplete tail
+            consumed = self.parse_safely(data, 0, len(data))
+            if consumed < len(data):
+                self.append(memoryview(data)[consumed:])
+        else:
+            self.append(data)
+            self.parse_buffer()
+
+    def append(self, data: bytes):
+        self.make_room(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def parse_buffer(self):
+        self.start += self.parse_safely(self.buffer, self.start, self.end)
+
+    def exported(self) -> bool:
+        # body memoryviews handed out earlier may still be held (e.g. queued by a transport),
+        # a bytearray cannot be resized while they are alive
         try:
-            if self.state == self.ParseStateEnum.header_parse:
-                f = BytesIO(self.unprocessed + data)
-                self.unprocessed = b''
-                self.parse_header(f)
-            elif self.state == self.ParseStateEnum.body_stream:
-                self.parse_body(data)
+            self.buffer.append(0)
+        except BufferError:
+            return True
+        self.buffer.pop()
+        return False
+
+    def make_room(self, size: int):
+        if len(self.buffer) - self.end >= size:
+            return
+        unparsed = self.end - self.start
+        buffer_size = len(self.buffer)
+        while buffer_size - unparsed < size:
+            buffer_size *= 2
+        if buffer_size == len(self.buffer) and not self.exported():
+            self.buffer[:unparsed] = self.buffer[self.start:self.end]
+        else:
+            buffer = bytearray(buffer_size)
+            buffer[:unparsed] = self.buffer[self.start:self.end]
+            self.buffer = buffer
+        self.start, self.end = 0, unparsed
+
+    def parse_safely(self, data: Union[bytes, bytearray], start: int, end: int) -> int:
+        try:
+            return self.parse(data, start, end)
         except ParserCallbackError:
-            self.reset()
+            self.discard()
             raise
         except Exception as e:
-            self.reset()
+            self.discard()
             raise ImitateHttpParserError(e)
 
+    def discard(self):
+        self.reset()
+        self.start = self.end = 0
 
     def catch_callback_error(self, func, *args, **kwargs):
         try:
@@ -148,66 +350,89 @@ class ImitateHttpParser(object):
         except Exception as e:
             raise ParserCallbackError(e)
 
-    def parse_header(self, f: BytesIO):
-        while True:
-            header = f.readline()
-            if header == b'\n':  # header parse done
-                if not self.command:
-                    raise ImitateHttpParserError('header parse complete without command')
-                content_length = self.headers.get('ContentLength')
-                if content_length:
-                    self.headers['ContentLength'] \
-                        = self.expected_body_length = int(content_length)
-                    if self.headers['ContentLength'] <= 0:
-                        raise ImitateHttpParserError('content length must gt than 0')
-                    self.state = self.ParseStateEnum.body_stream
-
-                self.catch_callback_error(
-                    self.protocol.command_complete,
-                    self.command,
-                    self.headers
-                )
+    def parse(self, data: Union[bytes, bytearray], start: int, end: int) -> int:
+        # iterative state machine over data[start:end], returns the number of bytes consumed
+        pos = start
+        with memoryview(data) as view:
+            while pos < end:
+                if self.state == self.ParseStateEnum.raw:
+                    # read together with the switching frame
+                    self.catch_callback_error(self.protocol.on_raw_data, view[pos:end])
+                    pos = end
+                    continue
 
                 if self.state == self.ParseStateEnum.body_stream:
-                    body_data = f.read()
-                    if body_data:
-                        self.parse_body(body_data)
-                    return
-                else:
-                    self.reset()
-                    another_command = f.read()
-                    if another_command:
-                        self.parse_header(BytesIO(another_command))
-
-            elif header.endswith(b'\n'):  # parse a single header line
-                header = header.strip().decode()
-                header_k, header_v = header.split(':', 1)
-                if header_k == 'Command':
-                    self.command = header_v.strip()
+                    body_end = min(end, pos + self.expected_body_length)
+                    self.expected_body_length -= body_end - pos
+                    self.catch_callback_error(self.protocol.body_stream, view[pos:body_end])
+                    pos = body_end
+                    if not self.expected_body_length:
+                        self.reset()
+                    continue
+
+                if data[pos] == BINARY_FRAME_MAGIC:
+                    consumed = self.parse_binary_header(data, pos, end)
                 else:
-                    self.headers[header_k] = header_v.strip()
+                    consumed = self.parse_text_header(data, pos, end)
+                if not consumed:  # incomplete header, wait for more data
+                    if end - pos > self.MaxHeaderSize:
+                        raise ImitateHttpParserError('header too large')
+                    break
+                pos += consumed
+        return pos - start
+
+    def parse_binary_header(self, data: Union[bytes, bytearray], pos: int, end: int) -> int:
+        header_end = pos + BINARY_FRAME_HEADER.size
+        if end < header_end:
+            return 0
+        _, code, flags, header_block_length, body_length = BINARY_FRAME_HEADER.unpack_from(data, pos)
+        stream_id = None
+        if flags & FRAME_FLAG_STREAM:
+            if end < header_end + FRAME_STREAM_ID.size:
+                return 0
+            stream_id = FRAME_STREAM_ID.unpack_from(data, header_end)[0]
+            header_end += FRAME_STREAM_ID.size
+        if end < header_end + header_block_length:
+            return 0
+        if code not in CODE_COMMANDS:
+            raise ImitateHttpParserError(f'unknown command code {code}')
+        headers = decode_header_block(data[header_end:header_end + header_block_length]) \
+            if header_block_length else {}
+        if stream_id is not None:
+            headers['StreamId'] = stream_id
+        if flags & FRAME_FLAG_COMPRESSED:
+            headers['Compressed'] = '1'
+        self.header_complete(CODE_COMMANDS[code], headers, body_length)
+        return header_end + header_block_length - pos
+
+    def parse_text_header(self, data: Union[bytes, bytearray], pos: int, end: int) -> int:
+        header_end = data.find(b'\n\n', pos, end)
+        if header_end < 0:
+            return 0
+        headers = decode_header_block(data[pos:header_end])
+        command = headers.pop('Command', '')
+        content_length = int(headers.get('ContentLength', 0))
+        if 'ContentLength' in headers and content_length <= 0:
+            raise ImitateHttpParserError('content length must gt than 0')
+        self.header_complete(command, headers, content_length)
+        return header_end + 2 - pos
+
+    def header_complete(self, command: str, headers: Dict[str, Any], body_length: int):
+        if not command:
+            raise ImitateHttpParserError('header parse complete without command')
+        self.command = command
+        self.headers = headers
+        if body_length:
+            self.headers['ContentLength'] = self.expected_body_length = body_length
+            self.state = self.ParseStateEnum.body_stream
 
-            elif header == b'':  # data end
-                return
-            else:
-                self.unprocessed = header
-
-    def parse_body(self, data: bytes):
-        expected_body_length = self.expected_body_length
-        body_length = len(data)
-        body = data[:expected_body_length]
         self.catch_callback_error(
-            self.protocol.body_stream,
-            body
+            self.protocol.command_complete,
+            self.command,
+            self.headers
         )
-
-        if body_length < expected_body_length:
-            self.expected_body_length -= body_length
-        elif body_length == expected_body_length:
+        if self.state == self.ParseStateEnum.header_parse:
             self.reset()
-        else:
-            self.reset()
-            self.parse_header(BytesIO(data[expected_body_length:]))
 
 
 class AuthProtocol(ImitateHttpProtocol):
@@ -244,16 +469,27 @@ class AuthProtocol(ImitateHttpProtocol):
         if self.state != ProtocolAuthState.AuthSuccess:
             self.auth_timer.cancel()
 
+    def check_token(self, token: Optional[str]) -> bool:
+        return token == self.AuthToken
+
     def on_auth_token_checked(self, headers):
         return True
 
+    def negotiate_framing(self, headers) -> FramingEnum:
+        if headers.get('Framing') == FramingEnum.binary and Settings.framing == FramingEnum.binary:
+            return FramingEnum.binary
+        return FramingEnum.text
+
     def command_complete(self, command: CommandEnum, headers: Dict[str, Any]):
         if command == CommandEnum.AuthRequire:
             self.auth_timer.cancel()
-            if headers.get('AuthToken') == self.AuthToken:
+            if self.check_token(headers.get('AuthToken')):
                 if self.on_auth_token_checked(headers):
                     self.state = ProtocolAuthState.AuthSuccess
-                    self.send(CommandEnum.AuthSuccess)
+                    framing = self.negotiate_framing(headers)
+                    # AuthSuccess itself always goes out as text, old clients only speak text
+                    self.send(CommandEnum.AuthSuccess, headers={'Framing': framing.value})
+                    self.framing = framing
                     self.auth_waiter.set_result(self)
                     self.on_auth_success(headers)
             else:
@@ -264,7 +500,7 @@ class AuthProtocol(ImitateHttpProtocol):
             self.check_auth()
             self.on_command_complete(command, headers)
 
-    def body_stream(self, body: bytes):
+    def body_stream(self, body: memoryview):
         self.check_auth()
         self.on_body_stream(body)
 
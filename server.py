@@ -4,12 +4,13 @@ import uvicorn
 from fastapi import FastAPI, Request, Depends
 
 from settings import Settings
-from server.proxy_server import ProxyServerFactory
 from server.relay_server import RelayServer
 from command.http_web import app
 from server.manager_server import ManagerServer
-from server.relay_pool import RelayPool
+from server.workers import WorkerSupervisor, WorkerProxyServerFactory, check_worker_ports
 from broadcaster import BroadCaster
+from server.tenants import TenantRegistry, Tenant, DEFAULT_TENANT, build_tenant
+from utils.event_loop import install_event_loop
 
 
 def register_app(
@@ -18,24 +19,48 @@ def register_app(
 
     @app.on_event('startup')
     async def start_relay_server():
-        broadcaster = BroadCaster()
-        relay_pool = RelayPool(broadcaster)
-        relay_server = RelayServer(relay_pool, broadcaster)
-        manager_server = ManagerServer(broadcaster)
-        proxy_server_factory = ProxyServerFactory(relay_pool, manager_server, broadcaster)
-        setattr(app, 'proxy_pool', relay_pool)
-        setattr(app, 'proxy_server_factory', proxy_server_factory)
-        setattr(app, 'relay_server', relay_server)
+        if Settings.server_workers > 1:
+            if Settings.tenants:
+                raise RuntimeError('tenants are served by a single server process, set server_workers to 1')
+            check_worker_ports()
+
+            # relays and proxy listeners run in worker processes, this one keeps the manager and the mappings
+            def build_worker_tenant(tenant_id: str, broadcaster: BroadCaster) -> Tenant:
+                supervisor = WorkerSupervisor(broadcaster)
+                proxy_server_factory = WorkerProxyServerFactory(manager_server, broadcaster, supervisor)
+                return Tenant(tenant_id, broadcaster, supervisor, proxy_server_factory)
+            tenants = TenantRegistry(build_worker_tenant)
+            manager_server = ManagerServer(tenants)
+            supervisor = tenants.get(DEFAULT_TENANT).pool
+            setattr(app, 'workers', supervisor)
+            await supervisor.start()
+        else:
+            tenants = TenantRegistry(lambda tenant_id, broadcaster: build_tenant(tenant_id, broadcaster, manager_server))
+            manager_server = ManagerServer(tenants)
+            relay_server = RelayServer(tenants)
+            setattr(app, 'relay_server', relay_server)
+            await relay_server.start()
+        setattr(app, 'tenants', tenants)
         setattr(app, 'manager_server', manager_server)
-        await relay_server.start()
         await manager_server.start()
-        for inner_endpoint, bind_port in Settings.internal_endpoints:
-            await proxy_server_factory.create_server(inner_endpoint, bind_port)
+        # internal endpoints belong to the default tenant
+        tenant = tenants.get(DEFAULT_TENANT)
+        for inner_endpoint, bind_port in Settings.internal_endpoints if tenant else ():
+            await tenant.proxy_server_factory.create_server(inner_endpoint, bind_port)
+
+    @app.on_event('shutdown')
+    async def stop_workers():
+        supervisor = getattr(app, 'workers', None)
+        if supervisor:
+            supervisor.stop()
 
 
 def run():
     register_app(app)
-    uvicorn.run(app, host=Settings.http_command_host, port=Settings.http_command_port, log_level=10)
+    install_event_loop()
+    # uvicorn takes the loop set here, newer uvloop policies no longer create one on first get_event_loop
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    uvicorn.run(app, host=Settings.http_command_host, port=Settings.http_command_port, log_level=10, loop='none')
 
 
 if __name__ == '__main__':
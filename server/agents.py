@@ -0,0 +1,43 @@
+from typing import Optional, Dict, Any, Iterable
+
+from settings import Settings
+
+
+class AgentLoad(object):
+    # load of one client agent as seen by this process, its relays are handed out while it is the least loaded
+    def __init__(self):
+        self.tunnels = 0  # active tunnels on the agent's relays
+        self.bytes = 0  # relay traffic since the last sample
+        self.throughput = 0.0  # bytes/s
+        self.rtt = 0.0  # seconds, of the agent's manager connection
+
+    def sample(self, elapsed: float, rtt: Optional[float] = None):
+        rate = self.bytes / max(elapsed, 1e-3)
+        self.throughput = 0.7 * self.throughput + 0.3 * rate
+        self.bytes = 0
+        if rtt is not None:
+            self.rtt = rtt
+
+    def score(self) -> float:
+        return self.tunnels + self.throughput / Settings.agent_load_bytes + self.rtt / Settings.agent_load_rtt
+
+    def dict(self) -> Dict[str, Any]:
+        return {
+            'tunnels': self.tunnels,
+            'throughput': round(self.throughput),
+            'rtt': round(self.rtt, 6),
+            'score': round(self.score(), 3),
+        }
+
+
+def apply_new_replier(agents: Iterable, num: int):
+    # every requested relay goes to the agent least loaded counting the relays it was already asked for
+    asked = {agent: 0 for agent in agents}
+    if not asked:
+        return
+    for _ in range(num):
+        agent = min(asked, key=lambda a: a.load.score() + asked[a])
+        asked[agent] += 1
+    for agent, count in asked.items():
+        if count:
+            agent.apply_new_replier(count)
@@ -1,4 +1,5 @@
-from typing import NoReturn, Optional, Dict, Any
+import json
+from typing import NoReturn, Optional, Dict, Any, List
 import asyncio
 from asyncio.futures import Future
 from asyncio.base_events import Server
@@ -6,11 +7,13 @@ from asyncio.base_events import Server
 from loguru import logger
 
 from settings import Settings
-from utils.sockets import get_remote_addr, set_socket_keepalive
+from utils.sockets import get_remote_addr, set_socket_keepalive, get_tcp_rtt
 from utils.decorators import future_add_callback
 from utils.tools import uid_base64
 from protocols import ImitateHttpProtocol, CommandEnum, ProtocolAuthState, AuthProtocol
-from broadcaster import BroadCaster, Event
+from broadcaster import Event
+from server.agents import AgentLoad
+from server.tenants import TenantRegistry, tenant_of_token
 
 MANAGER_SOCKET_IS_CLOSED = 'manager socket is closed'
 MANAGER_UNCONNECTED = 'manager unconnected'
@@ -22,6 +25,14 @@ class ManagerProtocol(AuthProtocol):
         self.epoch = epoch
         self.close_waiter = Future()
         self.session_id: Optional[str] = None
+        self.agent_id: Optional[str] = None
+        self.tenant_id: Optional[str] = None
+        self.multiplex = False
+        self.load = AgentLoad()
+        # local connect time histograms reported by the client, by endpoint
+        self.connect_times: Dict[str, Dict[str, Any]] = {}
+        # relay connection attempts of the client: counts and connect latency histogram
+        self.relay_dials: Dict[str, Any] = {}
 
     def get_close_waiter(self):
         return self.close_waiter
@@ -32,30 +43,55 @@ class ManagerProtocol(AuthProtocol):
             self.close_waiter.set_result(self)
             logger.info(f'Manager Client<{"%s:%s" % get_remote_addr(self.transport)}> connect lost')
 
+    def check_token(self, token: Optional[str]) -> bool:
+        self.tenant_id = tenant_of_token(token)
+        return self.tenant_id is not None
+
     def on_auth_success(self, headers):
         self.session_id = uid_base64()
+        self.agent_id = headers.get('AgentId') or '%s:%s' % get_remote_addr(self.transport)
+        self.multiplex = Settings.relay_multiplex and headers.get('Multiplex') == '1'
         sock = self.transport.get_extra_info('socket')
         set_socket_keepalive(sock)
-        logger.success(f'Manager Client<{"%s:%s" % get_remote_addr(self.transport)}> auth success')
+        logger.success(f'Manager Client<{"%s:%s" % get_remote_addr(self.transport)}> auth success, '
+                       f'tenant {self.tenant_id} agent {self.agent_id}')
+
+    def on_command_complete(self, command: CommandEnum, headers: Dict[str, Any]):
+        if command == CommandEnum.ClientMetrics:
+            self.connect_times = json.loads(headers['ConnectTimes'])
+            self.relay_dials = json.loads(headers.get('RelayDials', '{}'))
+
+    def sample_load(self, elapsed: float):
+        self.load.sample(elapsed, get_tcp_rtt(self.transport.get_extra_info('socket')))
+
+    def merge_load(self, reports: List[Dict[str, Any]]):
+        # with worker processes the agent's relays are theirs: tunnels and throughput are the sum of what they
+        # report, the rtt of the manager connection is measured here
+        self.load.tunnels = sum(report['tunnels'] for report in reports)
+        self.load.throughput = sum(report['throughput'] for report in reports)
+        rtt = get_tcp_rtt(self.transport.get_extra_info('socket'))
+        if rtt is not None:
+            self.load.rtt = rtt
 
     def on_auth_fail(self):
         logger.info(f'Manager Client<{"%s:%s" % get_remote_addr(self.transport)}> auth fail')
 
-    def apply_new_replier(self, num=1):
+    def apply_new_replier(self, num=1, relay_port: Optional[int] = None):
         self.check_auth()
-        self.send(
-            CommandEnum.NewReplier,
-            headers={
-                'ReplierNum': num,
-                'ManagerSessionId': self.session_id
-            }
-        )
+        headers = {
+            'ReplierNum': num,
+            'ManagerSessionId': self.session_id
+        }
+        if relay_port:
+            # multi-worker server: relays must reach the worker that asked for them
+            headers['RelayPort'] = relay_port
+        self.send(CommandEnum.NewReplier, headers=headers)
 
 
 class ManagerServer(object):
-    def __init__(self, broadcaster: BroadCaster):
+    def __init__(self, tenants: TenantRegistry):
         self.server: Optional[Server] = None
-        self.broadcaster = broadcaster
+        self.tenants = tenants
         self.epoch = 1
 
     def build_protocol(self) -> ManagerProtocol:
@@ -64,21 +100,23 @@ class ManagerServer(object):
         @future_add_callback(protocol.get_auth_waiter())
         def on_auth_done(f):
             self.epoch += 1
-            # kick out active manager
-            if self.broadcaster.manager_protocol:
-                self.broadcaster.manager_protocol.send(CommandEnum.ManagerKickOut)
-                self.broadcaster.manager_protocol.transport.close()
-                self.broadcaster.fire(Event.ManagerProtocolClose, self.broadcaster.manager_protocol)
-
-            # broadcast new manager connect
-            self.broadcaster.fire(Event.ManagerProtocolValid, protocol)
-            if Settings.idle_replier_num > 0:
-                protocol.apply_new_replier(Settings.idle_replier_num)
+            broadcaster = self.tenants.get(protocol.tenant_id).broadcaster
+            # kick out the tenant's active manager, with several agents only an earlier session of the same agent
+            for agent in list(broadcaster.agents.values()):
+                if Settings.multi_agent and agent.agent_id != protocol.agent_id:
+                    continue
+                agent.send(CommandEnum.ManagerKickOut)
+                agent.transport.close()
+                broadcaster.fire(Event.ManagerProtocolClose, agent)
+
+            # broadcast new manager connect, RelayPool requests the first relays
+            broadcaster.fire(Event.ManagerProtocolValid, protocol)
 
         @future_add_callback(protocol.get_close_waiter())
         def on_close_done(f):
-            if self.broadcaster.manager_protocol is protocol:
-                self.broadcaster.fire(Event.ManagerProtocolClose, protocol)
+            broadcaster = self.tenants.get(protocol.tenant_id).broadcaster
+            if broadcaster.agent_alive(protocol):
+                broadcaster.fire(Event.ManagerProtocolClose, protocol)
         return protocol
 
     async def start(self) -> NoReturn:
@@ -8,78 +8,239 @@ from asyncio.tasks import Task
 
 from loguru import logger
 
+from settings import Settings
 from py_types import TypeEndpoint
 from protocols import ForbiddenProtocol, BaseProtocol
 from tunnel import Tunnel, TunnelPoint, FakeCloseTunnel
+from mapping import MappingOptions, MappingStats
+from shaping import TokenBucket
 from server.relay_pool import RelayPool
+from server.warm_tunnels import WarmTunnels
 from server.manager_server import ManagerServer
 from broadcaster import BroadCaster, Event
 
 
 class ProxyProtocol(BaseProtocol, TunnelPoint):
-    def __init__(self, endpoint: TypeEndpoint, close_waiter: Future, pool: RelayPool):
+    def __init__(self, endpoint: TypeEndpoint, close_waiter: Future, pool: RelayPool,
+                 options: MappingOptions, stats: MappingStats, shaper_in: TokenBucket, shaper_out: TokenBucket,
+                 warm: Optional[WarmTunnels] = None):
         super().__init__()
         self.endpoint = endpoint
+        self.warm = warm
+        self.options = options
+        self.stats = stats
+        self.shaper_in = shaper_in
+        self.shaper_out = shaper_out
         self.close_waiter = close_waiter
         self.pool = pool
         self.task: Optional[Task] = None
         self.body_buffer = []
+        self.body_buffer_size = 0
+        self.reading = True
+        self.tunnel_paused = False
+        self.write_paused = False
+        # set while the mapping is over its rate in that direction
+        self.rate_in_timer: Optional[asyncio.TimerHandle] = None
+        self.rate_out_timer: Optional[asyncio.TimerHandle] = None
+        # set while parked: no client agent is connected, the connection waits reconnect_grace for one
+        self.park_timer: Optional[asyncio.TimerHandle] = None
 
     def connection_made(self, transport) -> NoReturn:
         super(ProxyProtocol, self).connection_made(transport)
+        self.stats.accepts += 1
+        self.stats.active += 1
+        repeater = self.warm.take() if self.warm else None
+        if repeater:
+            self.stats.acquire_wait.observe(0)
+            self.build_tunnel(repeater)
+            return
+        if self.pool.broadcaster.manager_protocol is None:
+            self.park()
         loop = asyncio.get_event_loop()
         self.task = loop.create_task(self.create_tunnel())
 
     async def create_tunnel(self):
-        repeater = await self.pool.get()  # todo in case new repeater connect done, but not in use, idle more than max
-        tunnel = Tunnel(self, repeater, self.endpoint)
+        start = self._loop.time()
+        try:
+            repeater = await self.pool.acquire(self.options.priority, self.options.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.stats.acquire_timeouts += 1
+            self.transport.close()
+            return
+        self.stats.acquire_wait.observe(self._loop.time() - start)
+        self.build_tunnel(repeater)
+
+    def build_tunnel(self, repeater: TunnelPoint):
+        self.body_buffer_size = 0
+        if self.park_timer:
+            self.park_timer.cancel()
+            self.park_timer = None
+            self.stats.parked -= 1
+        tunnel = Tunnel(self, repeater, self.endpoint, self.options, self.stats)
         tunnel.build()
         while self.body_buffer:
             tunnel.write(self, self.body_buffer.pop(0))
+        self.update_reading()
 
     def connection_lost(self, exc: Optional[Exception]):
+        self.stats.active -= 1
+        self.unpark()
         if self.task and not self.task.done():
             self.task.cancel()
+        for timer in (self.rate_in_timer, self.rate_out_timer):
+            if timer:
+                timer.cancel()
 
         self.body_buffer = []
         self.tunnel.close(self, exc)
         self.close_waiter.set_result(self)
 
     def data_received(self, data: bytes):
+        self.stats.bytes_in += len(data)
+        delay = self.shaper_in.consume(len(data))
+        if delay and self.rate_in_timer is None:
+            self.rate_in_timer = self._loop.call_later(delay, self.on_rate_in)
+            self.update_reading()
         if not isinstance(self.tunnel, FakeCloseTunnel):
             self.tunnel.write(self, data)
         else:
             self.body_buffer.append(data)
+            self.body_buffer_size += len(data)
+            self.update_reading()
+
+    def update_reading(self):
+        # reading from the user stops while the relay side is backed up, while the buffer waiting for a relay
+        # is full and while the mapping is over its inbound rate
+        paused = self.tunnel_paused or self.rate_in_timer is not None or self.park_timer is not None \
+            or self.body_buffer_size >= Settings.write_buffer_high
+        if paused == self.reading:
+            self.reading = not paused
+            if paused:
+                self.transport.pause_reading()
+            else:
+                self.transport.resume_reading()
+
+    def update_source(self):
+        # the relay side stops reading while the user cannot take more or the mapping is over its outbound rate
+        if self.write_paused or self.rate_out_timer is not None:
+            self.tunnel.pause(self)
+        else:
+            self.tunnel.resume(self)
+
+    def park(self):
+        # the relay request is still queued in the pool, the agent coming back serves it
+        if self.park_timer:
+            return
+        self.stats.parked += 1
+        self.park_timer = self._loop.call_later(Settings.reconnect_grace, self.on_park_timeout)
+        self.update_reading()
+
+    def unpark(self):
+        if not self.park_timer:
+            return
+        self.park_timer.cancel()
+        self.park_timer = None
+        self.stats.parked -= 1
+        if not self.transport.is_closing():
+            self.update_reading()
+
+    def on_park_timeout(self):
+        self.park_timer = None
+        self.stats.parked -= 1
+        self.stats.park_timeouts += 1
+        self.transport.close()
+
+    def on_rate_in(self):
+        self.rate_in_timer = None
+        self.update_reading()
+
+    def on_rate_out(self):
+        self.rate_out_timer = None
+        self.update_source()
 
     def on_tunnel_close(self, exc: Optional[Exception]):
         self.transport.close()
 
+    def splice_ready(self) -> bool:
+        # nothing of the tunnel held here and no rate limit, which has to see the bytes
+        return not (self.shaper_in.rate or self.shaper_out.rate or self.rate_in_timer or self.rate_out_timer
+                    or self.body_buffer or self.transport.is_closing() or self.transport.get_write_buffer_size())
+
+    def stop_splice(self):
+        if self.tunnel.splice:
+            self.tunnel.client.stop_splice()
+
     def on_tunnel_write(self, data: bytes):
+        self.stats.bytes_out += len(data)
         self.transport.write(data)
+        delay = self.shaper_out.consume(len(data))
+        if delay and self.rate_out_timer is None:
+            self.rate_out_timer = self._loop.call_later(delay, self.on_rate_out)
+            self.update_source()
+
+    def on_tunnel_pause(self):
+        self.tunnel_paused = True
+        self.update_reading()
+
+    def on_tunnel_resume(self):
+        self.tunnel_paused = False
+        self.update_reading()
+
+    def pause_writing(self):
+        self.write_paused = True
+        self.update_source()
+
+    def resume_writing(self):
+        self.write_paused = False
+        self.update_source()
 
 
 class ProxyServer(object):
-    def __init__(self, server_id: int, endpoint: TypeEndpoint):
+    def __init__(self, server_id: int, endpoint: TypeEndpoint, options: Optional[MappingOptions] = None):
         self.sock_server: Optional[Server] = None
         self.endpoint = endpoint
+        # read when a tunnel is built, changing them affects new connections only
+        self.options = options or MappingOptions()
+        self.stats = MappingStats()
+        # bandwidth limits apply to the running connections too
+        self.shaper_in = TokenBucket(self.options.rate_in, self.options.rate_burst)
+        self.shaper_out = TokenBucket(self.options.rate_out, self.options.rate_burst)
         self.create_at = datetime.datetime.now()
         self.server_id = server_id
-        self.protocols: List[ProxyProtocol] = []
+        self.protocols: Set[ProxyProtocol] = set()
         self.bind: Optional[TypeEndpoint] = None
+        # started by the factory serving the mapping's port
+        self.warm: Optional[WarmTunnels] = None
 
     def set_sock_server(self, sock_server: Server):
         self.sock_server = sock_server
         self.bind = self.sock_server.sockets[0].getsockname()
 
+    def update_options(self, options: MappingOptions):
+        old, self.options = self.options, options
+        if self.warm:
+            if (old.to_headers(), old.compression) != (options.to_headers(), options.compression):
+                self.warm.retire_all()
+            self.warm.wake()
+        self.shaper_in.configure(options.rate_in, options.rate_burst)
+        self.shaper_out.configure(options.rate_out, options.rate_burst)
+        if options.rate_in or options.rate_out:
+            for protocol in self.protocols:
+                protocol.stop_splice()
+
+    def full(self) -> bool:
+        return 0 < self.options.max_connections <= len(self.protocols)
+
     def build_protocol(self, pool: RelayPool) -> ProxyProtocol:
         close_waiter = Future()
         close_waiter.add_done_callback(self.remove_protocol)
-        proxy_protocol = ProxyProtocol(self.endpoint, close_waiter, pool)
-        self.protocols.append(proxy_protocol)
+        proxy_protocol = ProxyProtocol(self.endpoint, close_waiter, pool, self.options, self.stats,
+                                       self.shaper_in, self.shaper_out, self.warm)
+        self.protocols.add(proxy_protocol)
         return proxy_protocol
 
     def remove_protocol(self, f: Future):
-        self.protocols.remove(f.result())
+        self.protocols.discard(f.result())
 
 
 class ProxyServerFactory(object):
@@ -87,38 +248,62 @@ class ProxyServerFactory(object):
 
     def __init__(self, pool: RelayPool, manager_server: ManagerServer, broadcaster: BroadCaster):
         self.servers: Dict[TypeEndpoint, Optional[ProxyServer]] = {}
+        self.servers_by_id: Dict[int, ProxyServer] = {}
         self.pool = pool
         self.manager = manager_server
         self.broadcaster = broadcaster
+        self.broadcaster.add_watcher(Event.ManagerProtocolValid, self.broadcaster_handle)
         self.broadcaster.add_watcher(Event.ManagerProtocolClose, self.broadcaster_handle)
 
     def broadcaster_handle(self, event: Event, payload):
-        if event == Event.ManagerProtocolClose:
+        if event == Event.ManagerProtocolValid:
             for server in self.servers.values():
+                if not server:
+                    continue
+                if server.warm:
+                    server.warm.wake()
                 for p in server.protocols:
-                    if p.task and not p.task.done():
+                    p.unpark()
+        elif event == Event.ManagerProtocolClose:
+            # established tunnels drain on their relays, connections still waiting for a relay are parked
+            # once no agent is left to serve them, or closed without a reconnect grace
+            if self.broadcaster.agents:
+                return
+            for server in self.servers.values():
+                if not server:
+                    continue
+                for p in list(server.protocols):
+                    if not (p.task and not p.task.done()):
+                        continue
+                    if Settings.reconnect_grace:
+                        p.park()
+                    else:
                         p.task.cancel()
-                    p.transport.close()
+                        p.transport.close()
 
     def get_server_by_id(self, server_id: int) -> Optional[ProxyServer]:
-        for server in self.servers.values():
-            if server.server_id == server_id:
-                return server
-        return None
+        return self.servers_by_id.get(server_id)
 
-    async def create_server(self, endpoint: TypeEndpoint, bind_port: int = 0) -> Optional[ProxyServer]:
+    async def create_server(self, endpoint: TypeEndpoint, bind_port: int = 0,
+                            options: Optional[MappingOptions] = None, reuse_port: bool = False) -> Optional[ProxyServer]:
         loop = asyncio.get_event_loop()
         if endpoint in self.servers:
             return
         # simple lock
         self.servers.setdefault(endpoint, None)
         self.increment_id += 1
-        server = ProxyServer(self.increment_id, endpoint)
+        server = ProxyServer(self.increment_id, endpoint, options)
 
         def _build_protocol() -> Union[ProxyProtocol, ForbiddenProtocol]:
             if self.broadcaster.manager_protocol is None:
+                if not Settings.reconnect_grace:
+                    return ForbiddenProtocol()
+                if server.stats.parked >= Settings.reconnect_park_max:
+                    server.stats.park_overflows += 1
+                    return ForbiddenProtocol()
+            if server.full():
+                server.stats.rejected += 1
                 return ForbiddenProtocol()
-            self.broadcaster.manager_protocol.apply_new_replier(1)  # apply new relay
             protocol = server.build_protocol(self.pool)
             return protocol
         try:
@@ -126,26 +311,36 @@ class ProxyServerFactory(object):
                 _build_protocol,
                 host='0.0.0.0',
                 port=bind_port,
+                reuse_port=reuse_port,
             )
         except Exception as e:
             del self.servers[endpoint]
             raise e
         server.set_sock_server(sock_server)
+        server.warm = WarmTunnels(server, self.pool)
+        server.warm.start()
         logger.success(f'New ProxyServer Serving On '
                        f'{"%s:%s" % server.bind}->{"%s:%s" % endpoint}')
         self.servers[endpoint] = server
+        self.servers_by_id[server.server_id] = server
         return server
 
+    def update_options(self, server: ProxyServer, options: MappingOptions):
+        server.update_options(options)
+
     async def close_server(self, endpoint):
         server = self.servers.get(endpoint)
         if not server:
             return
         self.servers[endpoint] = None
+        del self.servers_by_id[server.server_id]
+        server.warm.stop()
         sock_server = server.sock_server
         sock_server.close()
         await sock_server.wait_closed()
         for p in server.protocols:
-            p.transport.close()
+            if p.transport:  # accepted while closing, connection_made still pending
+                p.transport.close()
         del self.servers[endpoint]
         logger.success(f'ProxyServer Close Done '
                        f'{"%s:%s" % server.bind}->{"%s:%s" % endpoint}')
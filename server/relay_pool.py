@@ -1,48 +1,225 @@
-from typing import Set
+import math
+import heapq
+import itertools
+from collections import deque, OrderedDict, defaultdict
+from typing import Deque, List, Optional, Tuple, Dict
+import asyncio
 from asyncio import Queue
 
 from loguru import logger
 
-from broadcaster import BroadCaster
+from settings import Settings
+from broadcaster import BroadCaster, Event
+from tunnel import TunnelPoint
+from server.agents import apply_new_replier
 
 
 class RelayPool(Queue):
-    def __init__(self, broadcaster: BroadCaster, loop=None):
-        super().__init__(loop=loop)
-        self._watchers: Set[callable] = set()
+    def __init__(self, broadcaster: BroadCaster):
+        # asyncio.Queue lost its loop argument in python 3.10, it uses the loop it is created in
+        super().__init__()
         self.broadcaster = broadcaster
+        self.broadcaster.add_watcher(Event.ManagerProtocolValid, self.broadcaster_handle)
+        self.broadcaster.add_watcher(Event.ManagerProtocolClose, self.broadcaster_handle)
 
-    def add_watcher(self, watcher: callable):
-        self._watchers.add(watcher)
+        # adaptive sizing state
+        self.requests: Deque[List] = deque()  # [request time, relays still expected]
+        self.acquiring = 0
+        self.arrivals = 0
+        self.arrival_rate = 0.0  # acquires per second
+        self.wait_time = 0.0  # seconds spent waiting for a relay
+        self.setup_latency = 0.0  # seconds from NewReplier to relay in pool
+        self.tick_handle: Optional[asyncio.TimerHandle] = None
+        self.last_tick = 0.0
+        # acquires served by an idle relay / that had to wait for one, relays rejected for a past manager session
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        # acquirers waiting for a relay: (time they count as waiting since, arrival order, future), a relay put
+        # back goes to the earliest; higher priority counts as having waited longer, so low priority still ages in
+        self.waiters: List[Tuple[float, int, asyncio.Future]] = []
+        self.waiter_order = itertools.count()
+        self.timeouts = 0
 
-    def remove_watcher(self, watcher: callable):
-        self._watchers.discard(watcher)
+    def broadcaster_handle(self, event: Event, payload):
+        self.requests.clear()
+        if event == Event.ManagerProtocolValid:
+            if payload.multiplex:
+                if Settings.multiplex_relay_num > 0:
+                    payload.apply_new_replier(Settings.multiplex_relay_num)
+            else:
+                self.replenish()
+            if self.tick_handle is None:
+                loop = asyncio.get_event_loop()
+                self.last_tick = loop.time()
+                self.tick_handle = loop.call_later(Settings.relay_pool_tick, self.tick)
 
-    def notify_watcher(self, event):
-        for watcher in self._watchers:
-            watcher(event)
+    def tick(self):
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        rate = self.arrivals / max(now - self.last_tick, 1e-3)
+        self.arrival_rate = 0.7 * self.arrival_rate + 0.3 * rate
+        self.arrivals = 0
+        for agent in self.broadcaster.agents.values():
+            agent.sample_load(now - self.last_tick)
+        self.last_tick = now
+        # drop the waiters that timed out or went away since
+        if any(waiter.done() for _, _, waiter in self.waiters):
+            self.waiters = [entry for entry in self.waiters if not entry[2].done()]
+            heapq.heapify(self.waiters)
+        self.replenish()
+        self.tick_handle = loop.call_later(Settings.relay_pool_tick, self.tick)
+
+    def target_size(self) -> int:
+        # cover the acquires expected while a new relay is being set up, twice that while acquirers still wait
+        headroom = self.arrival_rate * self.setup_latency
+        if self.wait_time > Settings.relay_pool_wait_target:
+            headroom *= 2
+        return min(Settings.idle_replier_num + math.ceil(headroom), Settings.relay_pool_max)
+
+    def outstanding(self) -> int:
+        deadline = asyncio.get_event_loop().time() - Settings.relay_request_timeout
+        while self.requests and self.requests[0][0] < deadline:
+            self.requests.popleft()
+        return sum(count for _, count in self.requests)
+
+    def replenish(self):
+        agents = [agent for agent in self.broadcaster.agents.values() if not agent.multiplex]
+        if not agents:
+            return
+        deficit = self.target_size() + self.acquiring - self.qsize() - self.outstanding()
+        if deficit <= 0:
+            return
+        self.requests.append([asyncio.get_event_loop().time(), deficit])
+        apply_new_replier(agents, deficit)
+
+    def on_new_relay(self):
+        if not self.requests:
+            return
+        request = self.requests[0]
+        latency = asyncio.get_event_loop().time() - request[0]
+        self.setup_latency = 0.8 * self.setup_latency + 0.2 * latency if self.setup_latency else latency
+        request[1] -= 1
+        if request[1] <= 0:
+            self.requests.popleft()
+
+    def stats(self):
+        return {
+            'size': self.qsize(),
+            'target': self.target_size(),
+            'acquiring': self.acquiring,
+            'outstanding': self.outstanding(),
+            'arrival_rate': round(self.arrival_rate, 3),
+            'wait_time': round(self.wait_time, 6),
+            'setup_latency': round(self.setup_latency, 6),
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'waiting': sum(not waiter.done() for _, _, waiter in self.waiters),
+            'timeouts': self.timeouts,
+        }
+
+    async def acquire(self, priority: int = 0, timeout: float = 0, account: bool = True) -> TunnelPoint:
+        # raises asyncio.TimeoutError when no relay came within timeout seconds, 0 waits as long as it takes.
+        # account=False is for relays taken ahead of any connection, warm tunnels: they count as no arrival,
+        # hit or miss and leave the wait time alone
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        if account:
+            self.arrivals += 1
+            if self.empty():
+                self.misses += 1
+            else:
+                self.hits += 1
+        self.acquiring += 1
+        # higher priority counts as having waited longer, kept when waiting again
+        since = start - priority * Settings.relay_priority_aging
+        try:
+            self.replenish()
+            while True:
+                if not self.empty():
+                    relay = self.get_nowait()
+                else:
+                    remaining = timeout - (loop.time() - start) if timeout else 0
+                    if timeout and remaining <= 0:
+                        self.timeouts += 1
+                        raise asyncio.TimeoutError()
+                    relay = await self.wait_relay(since, remaining)
+                # a relay handed to a waiter is in no queue, it may have closed before the waiter resumed
+                if not relay.transport.is_closing():
+                    break
+        finally:
+            self.acquiring -= 1
+        if account:
+            self.wait_time = 0.8 * self.wait_time + 0.2 * (loop.time() - start)
+        if not relay.multiplex:
+            return relay
+        stream = relay.open_stream()
+        if relay.has_stream_capacity():
+            # stays available for more streams, re-queued at the back so streams spread over relays
+            self.put_nowait(relay)
+        elif self.empty() and self.broadcaster.agent_alive(relay.manager_protocol):
+            relay.manager_protocol.apply_new_replier(1)
+        return stream
+
+    # idle relays in an ordered dict instead of the queue's deque: first in first out, and removing a closed
+    # relay from the middle costs O(1). With several agents the next relay is the first of the least loaded agent
+    def _init(self, maxsize):
+        self._queue = OrderedDict()
+        self.idle_by_agent: Dict[object, OrderedDict] = defaultdict(OrderedDict)
+
+    def _put(self, item):
+        self._queue[item] = None
+        self.idle_by_agent[item.manager_protocol][item] = None
+
+    def _get(self):
+        if len(self.idle_by_agent) == 1:
+            item = self._queue.popitem(last=False)[0]
+        else:
+            agent = min(self.idle_by_agent, key=lambda a: a.load.score())
+            item = self.idle_by_agent[agent].popitem(last=False)[0]
+            del self._queue[item]
+        self.discard_idle(item)
+        return item
+
+    def discard_idle(self, item):
+        idle = self.idle_by_agent[item.manager_protocol]
+        idle.pop(item, None)
+        if not idle:
+            del self.idle_by_agent[item.manager_protocol]
+
+    async def wait_relay(self, since: float, timeout: float) -> TunnelPoint:
+        loop = asyncio.get_event_loop()
+        waiter = loop.create_future()
+        heapq.heappush(self.waiters, (since, next(self.waiter_order), waiter))
+        timer = loop.call_later(timeout, self.expire_waiter, waiter) if timeout else None
+        try:
+            return await waiter
+        except asyncio.CancelledError:
+            # the connection went away just after a relay was handed to it
+            if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                self.put_nowait(waiter.result())
+            raise
+        finally:
+            if timer:
+                timer.cancel()
+
+    def expire_waiter(self, waiter: asyncio.Future):
+        if not waiter.done():
+            self.timeouts += 1
+            waiter.set_exception(asyncio.TimeoutError())
 
     def put_nowait(self, item):
+        # handed straight to the first waiter, gone waiters are dropped on the way
+        while self.waiters:
+            waiter = heapq.heappop(self.waiters)[2]
+            if not waiter.done():
+                waiter.set_result(item)
+                return
         super().put_nowait(item)
-        self.notify_watcher({
-            'event': 'new_replier',
-            'payload': item,
-        })
-
-    def get_nowait(self):
-        item = super().get_nowait()
-        self.notify_watcher({
-            'event': 'pop_replier',
-            'payload': item,
-        })
-        return item
 
     def remove(self, item):
-        try:
-            self._queue.remove(item)
-            self.notify_watcher({
-                'event': 'pop_replier',
-                'payload': item,
-            })
-        except ValueError:
-            pass
+        if item not in self._queue:
+            return
+        del self._queue[item]
+        self.discard_idle(item)
@@ -1,89 +1,425 @@
-from typing import NoReturn, Optional, Dict, Any, List, Union
+from typing import NoReturn, Optional, Dict, Any, List, Union, Set
 import asyncio
 from asyncio.futures import Future
 from asyncio.base_events import Server
-from asyncio.selector_events import _SelectorSocketTransport
 
 from loguru import logger
 
 from settings import Settings
 from utils.decorators import future_add_callback
 from utils.sockets import set_socket_keepalive, get_remote_addr
-from protocols import ImitateHttpProtocol, ForbiddenProtocol, CommandEnum, ProtocolAuthState, UnAuthError, AuthProtocol
-from tunnel import Tunnel, TunnelPoint
+from protocols import ImitateHttpProtocol, ForbiddenProtocol, CommandEnum, ProtocolAuthState, UnAuthError, AuthProtocol, \
+    FRAME_FLAG_COMPRESSED
+from tunnel import Tunnel, TunnelPoint, FakeCloseTunnel, ForwardCoalescer
+from multiplex import Multiplexer, MultiplexStream
+from compression import CODECS, ForwardCompressor, negotiate_codec
+from splice import SPLICE_AVAILABLE, start_splice
 from server.relay_pool import RelayPool
 from broadcaster import BroadCaster, Event
+from server.tenants import TenantRegistry, tenant_of_token
+
+
+class RelayStream(MultiplexStream):
+    def on_tunnel_build(self, tunnel: Tunnel):
+        self.set_codec(negotiate_codec(tunnel.options.compression, self.multiplexer.relay.codecs))
+        super().on_tunnel_build(tunnel)
+        headers = {'Endpoint': '%s:%s' % tunnel.endpoint, 'Window': self.window, **tunnel.options.to_headers()}
+        if self.codec:
+            headers['Compression'] = self.codec
+        self.send(CommandEnum.NewTunnel, headers=headers)
 
 
 class RelayProtocol(AuthProtocol, TunnelPoint):
-    def __init__(self, manager_protocol):
+    def __init__(self, tenants: TenantRegistry):
         super().__init__()
         self.close_waiter = Future()
-        self.manager_protocol = manager_protocol
+        self.tenants = tenants
+        # the agent whose manager session the relay authenticated for, and the pool and broadcaster of its tenant
+        self.manager_protocol = None
+        self.pool: Optional[RelayPool] = None
+        self.broadcaster: Optional[BroadCaster] = None
+        self.multiplexer: Optional[Multiplexer] = None
+        # dedicated relay reuse: a tunnel ends with a CloseTunnel exchange and the relay goes back to the pool
+        self.reusable = False
+        self.tunnel_count = 0
+        self.close_sent = False
+        self.close_received = False
+        self.write_paused = False
+        self.idle_timer: Optional[asyncio.TimerHandle] = None
+        self.coalescer: Optional[ForwardCoalescer] = None
+        self.compressor: Optional[ForwardCompressor] = None
+        self.compress_paused = False
+        # codecs the client offered at AuthRequire, the tunnel's codec is negotiated at NewTunnel
+        self.codecs: List[str] = []
+        self.decompressor = None
+        self.receive_compressed = False
+        # warm tunnel: bound to a mapping's endpoint before any connection, codec fixed at that NewTunnel
+        self.warm_capable = False
+        self.warm = None
+        self.warm_codec: Optional[str] = None
+        # the client can switch the relay to raw passthrough, raw_tunnel once the current tunnel is unframed
+        self.raw_capable = False
+        self.raw_tunnel = False
+        # the raw tunnel goes to the kernel as soon as no bytes of it are buffered in python
+        self.splice_wanted = False
+        # dedicated relay in a tunnel, counted in the agent's load
+        self.in_tunnel = False
+        # the agent went away: no new tunnels, closed once the current ones ended
+        self.draining = False
+
+    @property
+    def multiplex(self) -> bool:
+        return self.multiplexer is not None
 
     def get_close_waiter(self):
         return self.close_waiter
 
+    def check_token(self, token: Optional[str]) -> bool:
+        return tenant_of_token(token) is not None
+
     def on_auth_token_checked(self, headers):
-        if headers.get('ManagerSessionId') != self.manager_protocol.session_id:
+        tenant_id = tenant_of_token(headers.get('AuthToken'))
+        agent = self.tenants.find_agent(headers.get('ManagerSessionId'))
+        # the session ended, or belongs to another tenant
+        if agent is None or agent.tenant_id != tenant_id:
+            tenant = self.tenants.tenants.get(tenant_id)
+            if tenant:
+                tenant.pool.expired += 1
             self.send(CommandEnum.ManagerEpochChange)
-            self.transport.close()
+            self.close()
             self.state = ProtocolAuthState.Expired
             return False
+        tenant = self.tenants.tenants[tenant_id]
+        self.manager_protocol = agent
+        self.pool = tenant.pool
+        self.broadcaster = tenant.broadcaster
         return True
 
     def on_auth_success(self, headers):
         sock = self.transport.get_extra_info('socket')
         set_socket_keepalive(sock)
+        if Settings.relay_multiplex and headers.get('Multiplex') == '1':
+            self.multiplexer = Multiplexer(self, RelayStream)
+        self.reusable = Settings.relay_reuse and headers.get('RelayReuse') == '1'
+        self.codecs = headers.get('Compression', '').split(',')
+        self.warm_capable = not self.multiplex and headers.get('Warm') == '1'
+        self.raw_capable = not self.multiplex and headers.get('Raw') == '1'
 
     def connection_lost(self, exc: Optional[Exception]):
         super().connection_lost(exc)
+        if self.idle_timer:
+            self.idle_timer.cancel()
+        if self.coalescer:
+            self.coalescer.discard()
+            self.compressor.discard()
+        if self.multiplexer:
+            self.manager_protocol.load.tunnels -= len(self.multiplexer.streams)
+            self.multiplexer.close(exc)
+        if self.in_tunnel:
+            self.in_tunnel = False
+            self.manager_protocol.load.tunnels -= 1
+        if self.warm:
+            self.warm.discard(self)
+        self.tunnel.close(self, exc)
         if self.state == ProtocolAuthState.AuthSuccess:
             self.close_waiter.set_result(self)
 
+    def open_stream(self) -> RelayStream:
+        self.manager_protocol.load.tunnels += 1
+        return self.multiplexer.open_stream()
+
+    def has_stream_capacity(self) -> bool:
+        return len(self.multiplexer.streams) < Settings.multiplex_max_streams
+
+    def on_stream_close(self, stream: RelayStream):
+        self.manager_protocol.load.tunnels -= 1
+        if self.draining:
+            if not self.multiplexer.streams:
+                self.close()
+            return
+        # a full relay left the pool in RelayPool.acquire, give it back once a stream frees up
+        if len(self.multiplexer.streams) == Settings.multiplex_max_streams - 1 \
+                and not self.transport.is_closing():
+            self.pool.put_nowait(self)
+
+    def drain(self):
+        # the agent went away: an idle relay closes now, a busy one once its tunnels ended
+        self.draining = True
+        self.pool.remove(self)
+        if self.warm:
+            self.warm.discard(self)
+            self.warm = None
+        busy = self.multiplexer.streams if self.multiplexer else self.in_tunnel
+        if not busy:
+            self.close()
+
+    def release(self):
+        self.pool.put_nowait(self)
+        if not self.multiplex and Settings.relay_idle_timeout:
+            self.idle_timer = self._loop.call_later(Settings.relay_idle_timeout, self.on_idle_timeout)
+
+    def on_idle_timeout(self):
+        self.idle_timer = None
+        if self.pool.qsize() > self.pool.target_size():
+            self.close()
+        else:
+            self.idle_timer = self._loop.call_later(Settings.relay_idle_timeout, self.on_idle_timeout)
+
+    def tunnel_headers(self, endpoint, options, codec: Optional[str]) -> Dict[str, Any]:
+        headers = {'Endpoint': '%s:%s' % endpoint, **options.to_headers()}
+        if self.reusable:
+            headers['RelayReuse'] = 1
+        if codec:
+            headers['Compression'] = codec
+        return headers
+
+    def warm_up(self, warm):
+        # the client opens the local connection now and sends TunnelReady, the tunnel starts at TunnelActivate
+        if self.idle_timer:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+        self.warm = warm
+        self.warm_codec = negotiate_codec(warm.server.options.compression, self.codecs)
+        headers = self.tunnel_headers(warm.server.endpoint, warm.server.options, self.warm_codec)
+        headers['Warm'] = 1
+        self.send(CommandEnum.NewTunnel, headers=headers)
+
+    def retire(self):
+        # a warm tunnel no connection took, the client closes the local connection at CloseTunnel
+        self.warm = None
+        if not self.transport.is_closing():
+            self.end_tunnel()
+
     def on_tunnel_build(self, tunnel: Tunnel):
         super().on_tunnel_build(tunnel)
-        self.send(CommandEnum.NewTunnel, headers={'Endpoint': '%s:%s' % tunnel.endpoint})
+        if self.idle_timer:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+        self.tunnel_count += 1
+        self.in_tunnel = True
+        self.manager_protocol.load.tunnels += 1
+        codec = self.warm_codec if self.warm else negotiate_codec(tunnel.options.compression, self.codecs)
+        if Settings.relay_raw and self.raw_capable and not codec and not self.warm:
+            self.start_raw_tunnel(tunnel)
+            return
+        self.compress_paused = False
+        self.compressor = ForwardCompressor(codec, self.send_forward, self.on_compress_busy, tunnel.stats)
+        self.coalescer = ForwardCoalescer(self.compressor.write, tunnel.options, tunnel.stats)
+        self.decompressor = CODECS[codec].decompressor() if codec else None
+        if self.warm:
+            self.warm = None
+            self.send(CommandEnum.TunnelActivate)
+        else:
+            self.send(CommandEnum.NewTunnel, headers=self.tunnel_headers(tunnel.endpoint, tunnel.options, codec))
+        if self.write_paused:
+            tunnel.pause(self)
+
+    def start_raw_tunnel(self, tunnel: Tunnel):
+        # our bytes are raw right after NewTunnel, the client's after its TunnelRaw. The end of the tunnel
+        # can no longer be told in-band, so the relay is not reused
+        self.reusable = False
+        self.raw_tunnel = True
+        headers = self.tunnel_headers(tunnel.endpoint, tunnel.options, None)
+        headers['Raw'] = 1
+        self.send(CommandEnum.NewTunnel, headers=headers)
+        if self.write_paused:
+            tunnel.pause(self)
 
     def on_tunnel_close(self, exc: Optional[Exception]):
-        self.transport.close()
+        if self.raw_tunnel:
+            self.close()
+            return
+        # reading may be paused by the tunnel's backpressure, the client's CloseTunnel must still be read
+        self.transport.resume_reading()
+        # everything the tunnel wrote goes out before it ends
+        self.coalescer.flush()
+        self.compressor.finish(self.end_tunnel)
+
+    def end_tunnel(self):
+        if not self.reusable:
+            self.close()
+            return
+        self.close_sent = True
+        self.send(CommandEnum.CloseTunnel)
+        self.try_recycle()
+
+    def on_remote_tunnel_close(self):
+        self.close_received = True
+        if self.warm:
+            # the local connection of a warm tunnel closed or could not be opened
+            self.warm.discard(self)
+            self.warm = None
+        if self.coalescer:
+            self.coalescer.discard()
+            self.compressor.discard()
+        self.tunnel.close(self)
+        if not self.close_sent:
+            self.close_sent = True
+            self.send(CommandEnum.CloseTunnel)
+        self.try_recycle()
+
+    def try_recycle(self):
+        # both sides said CloseTunnel, nothing of the old tunnel can still be in flight
+        if not (self.close_sent and self.close_received) or self.transport.is_closing():
+            return
+        self.close_sent = self.close_received = False
+        self.tunnel = FakeCloseTunnel()
+        if self.in_tunnel:
+            self.in_tunnel = False
+            self.manager_protocol.load.tunnels -= 1
+        self.transport.resume_reading()
+        if self.draining or Settings.relay_max_reuse and self.tunnel_count >= Settings.relay_max_reuse:
+            self.close()
+        else:
+            self.release()
 
     def on_tunnel_write(self, data: bytes):
-        self.send(CommandEnum.Forward, body=data)
+        if self.raw_tunnel:
+            self.manager_protocol.load.bytes += len(data)
+            self.transport.write(data)
+            if self.splice_wanted:
+                self.try_splice()
+        else:
+            self.coalescer.write(data)
+
+    def send_forward(self, data: bytes, compressed: bool = False, size: Optional[int] = None):
+        self.send(CommandEnum.Forward, body=data, flags=FRAME_FLAG_COMPRESSED if compressed else 0)
+
+    def send(self, command: CommandEnum, headers: Optional[Dict[str, Any]] = None, body: bytes = b'',
+             stream_id: Optional[int] = None, flags: int = 0):
+        if self.manager_protocol:
+            self.manager_protocol.load.bytes += len(body)
+        super().send(command, headers, body, stream_id, flags)
+
+    def buffer_updated(self, nbytes: int):
+        if self.manager_protocol:
+            self.manager_protocol.load.bytes += nbytes
+        super().buffer_updated(nbytes)
+
+    def on_compress_busy(self, busy: bool):
+        self.compress_paused = busy
+        self.update_source()
+
+    def update_source(self):
+        if self.write_paused or self.compress_paused:
+            self.tunnel.pause(self)
+        else:
+            self.tunnel.resume(self)
+
+    def on_tunnel_pause(self):
+        self.transport.pause_reading()
+
+    def on_tunnel_resume(self):
+        self.transport.resume_reading()
+
+    def pause_writing(self):
+        self.write_paused = True
+        if self.multiplexer:
+            self.multiplexer.pause_streams()
+        else:
+            self.update_source()
+
+    def resume_writing(self):
+        self.write_paused = False
+        if self.multiplexer:
+            self.multiplexer.resume_streams()
+        else:
+            self.update_source()
+
+    def on_command_complete(self, command: CommandEnum, headers: Dict[str, Any]):
+        if self.multiplexer and 'StreamId' in headers:
+            self.multiplexer.command_complete(command, headers)
+        elif command == CommandEnum.Forward:
+            self.receive_compressed = 'Compressed' in headers
+        elif command == CommandEnum.CloseTunnel:
+            self.on_remote_tunnel_close()
+        elif command == CommandEnum.TunnelReady:
+            if self.warm:
+                self.warm.on_ready(self)
+        elif command == CommandEnum.TunnelRaw:
+            self.switch_raw()
+            self.splice_wanted = Settings.relay_splice and SPLICE_AVAILABLE
+            if self.splice_wanted:
+                self.try_splice()
+
+    def on_raw_data(self, data: Union[bytes, memoryview]):
+        self.tunnel.write(self, data)
+        if self.splice_wanted:
+            self.try_splice()
+
+    def try_splice(self):
+        proxy = self.tunnel.server
+        if self.transport.is_closing() or self.transport.get_write_buffer_size() or not proxy.splice_ready():
+            return
+        self.splice_wanted = False
+        start_splice(self.tunnel, proxy.transport, self.transport, self.on_splice_in, self.on_splice_out)
+
+    def stop_splice(self):
+        # a rate limit set on the mapping has to see the bytes, the tunnel goes back to copying them in python
+        splice = self.tunnel.splice
+        if splice and not splice.closed and not splice.on_fall_back:
+            splice.fall_back(self.on_splice_stopped)
+
+    def on_splice_stopped(self):
+        self.tunnel.splice = None
+        self.tunnel.server.update_reading()
+
+    def on_splice_in(self, size: int):
+        self.tunnel.stats.bytes_in += size
+        self.manager_protocol.load.bytes += size
+
+    def on_splice_out(self, size: int):
+        self.tunnel.stats.bytes_out += size
+        self.manager_protocol.load.bytes += size
 
-    def on_body_stream(self, body: bytes):
-        self.tunnel.write(self, body)
+    def on_body_stream(self, body: memoryview):
+        if self.multiplexer:
+            self.multiplexer.body_stream(body)
+        elif self.receive_compressed:
+            self.tunnel.write(self, self.decompressor.decompress(body))
+        else:
+            self.tunnel.write(self, body)
 
 
 class RelayServer(object):
-    def __init__(self, pool: RelayPool, broadcaster: BroadCaster):
+    def __init__(self, tenants: TenantRegistry, port: Optional[int] = None):
         self.server: Optional[Server] = None
-        self.pool = pool
-        self.broadcaster = broadcaster
-        self.protocols: List[RelayProtocol] = []
-        self.broadcaster.add_watcher(Event.ManagerProtocolClose, self.broadcaster_handle)
+        self.port = Settings.relay_port if port is None else port
+        self.tenants = tenants
+        self.protocols: Set[RelayProtocol] = set()
+        self.tenants.add_watcher(Event.ManagerProtocolClose, self.broadcaster_handle)
 
     def broadcaster_handle(self, event: Event, payload):
         if event == Event.ManagerProtocolClose:
-            for p in self.protocols:
-                p.transport.close()
-                self.pool.remove(p)
+            # a manager reconnect or an agent leaving invalidates the idle relays only, the tunnels on the
+            # others go on until they close by themselves
+            for p in list(self.protocols):
+                if p.manager_protocol is payload:
+                    p.drain()
 
     def build_protocol(self) -> Union[RelayProtocol, ForbiddenProtocol]:
-        manager_protocol = self.broadcaster.manager_protocol
-        if manager_protocol is None:
+        if not self.tenants.sessions:
             return ForbiddenProtocol()
-        protocol = RelayProtocol(manager_protocol)
+        protocol = RelayProtocol(self.tenants)
 
         @future_add_callback(protocol.get_auth_waiter())
         def on_auth_success(f):
-            self.protocols.append(protocol)
-            self.pool.put_nowait(protocol)
+            self.protocols.add(protocol)
+            if not protocol.multiplex:
+                protocol.pool.on_new_relay()
+            protocol.release()
 
         @future_add_callback(protocol.get_close_waiter())
         def on_close(f):
-            self.protocols.remove(protocol)
-            self.pool.remove(protocol)
+            self.protocols.discard(protocol)
+            protocol.pool.remove(protocol)
+            if not protocol.broadcaster.agent_alive(protocol.manager_protocol):
+                return
+            # keep the number of long-lived multiplexed relays steady
+            if protocol.multiplex:
+                protocol.manager_protocol.apply_new_replier(1)
+            else:
+                protocol.pool.replenish()
         return protocol
 
     async def start(self) -> NoReturn:
@@ -91,6 +427,6 @@ class RelayServer(object):
         self.server = await loop.create_server(
             self.build_protocol,
             host='0.0.0.0',
-            port=Settings.relay_port,
+            port=self.port,
         )
         logger.info(f'RelayServer serving on {"%s:%s" % self.server.sockets[0].getsockname()}')
\ No newline at end of file
@@ -0,0 +1,69 @@
+from typing import Optional, Dict, Any, Callable, List, Tuple, Set
+
+from settings import Settings
+from broadcaster import BroadCaster, Event, TypeEventHandler
+
+DEFAULT_TENANT = 'default'
+
+
+def tenant_of_token(token: Optional[str]) -> Optional[str]:
+    if Settings.tenants:
+        return Settings.tenants.get(token)
+    return DEFAULT_TENANT if token == Settings.auth_token else None
+
+
+def tenant_ids() -> Set[str]:
+    return set(Settings.tenants.values()) if Settings.tenants else {DEFAULT_TENANT}
+
+
+class Tenant(object):
+    # one site behind NAT: its client agents (on the broadcaster), relay pool and mappings
+    def __init__(self, tenant_id: str, broadcaster: BroadCaster, pool, proxy_server_factory):
+        self.tenant_id = tenant_id
+        self.broadcaster = broadcaster
+        self.pool = pool
+        self.proxy_server_factory = proxy_server_factory
+
+
+def build_tenant(tenant_id: str, broadcaster: BroadCaster, manager_server=None) -> Tenant:
+    # a tenant whose relays and mappings are served in this process
+    from server.relay_pool import RelayPool
+    from server.proxy_server import ProxyServerFactory
+    pool = RelayPool(broadcaster)
+    return Tenant(tenant_id, broadcaster, pool, ProxyServerFactory(pool, manager_server, broadcaster))
+
+
+class TenantRegistry(object):
+    # configured tenants, built on first use, and the agents of all of them by manager session id, so that
+    # a relay finds its agent and the agent's tenant with one lookup
+    def __init__(self, build_tenant: Callable[[str, BroadCaster], Tenant]):
+        self.build_tenant = build_tenant
+        self.tenants: Dict[str, Tenant] = {}
+        self.sessions: Dict[str, Any] = {}
+        # watchers added to the broadcaster of every tenant
+        self.watchers: List[Tuple[Event, TypeEventHandler]] = []
+
+    def get(self, tenant_id: str) -> Optional[Tenant]:
+        tenant = self.tenants.get(tenant_id)
+        if tenant is None and tenant_id in tenant_ids():
+            broadcaster = BroadCaster()
+            broadcaster.add_watcher(Event.ManagerProtocolValid, self.broadcaster_handle)
+            broadcaster.add_watcher(Event.ManagerProtocolClose, self.broadcaster_handle)
+            for event, handler in self.watchers:
+                broadcaster.add_watcher(event, handler)
+            tenant = self.tenants[tenant_id] = self.build_tenant(tenant_id, broadcaster)
+        return tenant
+
+    def add_watcher(self, event: Event, handler: TypeEventHandler):
+        self.watchers.append((event, handler))
+        for tenant in self.tenants.values():
+            tenant.broadcaster.add_watcher(event, handler)
+
+    def broadcaster_handle(self, event: Event, agent):
+        if event == Event.ManagerProtocolValid:
+            self.sessions[agent.session_id] = agent
+        elif self.sessions.get(agent.session_id) is agent:
+            del self.sessions[agent.session_id]
+
+    def find_agent(self, session_id: Optional[str]):
+        return self.sessions.get(session_id)
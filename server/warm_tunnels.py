@@ -0,0 +1,92 @@
+import asyncio
+from asyncio.tasks import Task
+from collections import OrderedDict
+from typing import Optional, Set, Dict
+
+from settings import Settings
+from server.relay_pool import RelayPool
+
+
+class WarmTunnels(object):
+    # relays bound ahead of time to one mapping's endpoint, the client opened the local connection of each and
+    # holds it unread until a connection of the mapping is spliced onto it, so that connection needs no round trip
+    def __init__(self, server, pool: RelayPool):
+        self.server = server
+        self.pool = pool
+        self.pending: Set = set()  # NewTunnel sent, local connection still opening
+        self.ready: Dict = OrderedDict()  # relay: timer replacing it after warm_tunnel_max_age
+        self.changed = asyncio.Event()
+        self.task: Optional[Task] = None
+
+    def start(self):
+        self.task = asyncio.get_event_loop().create_task(self.maintain())
+
+    def stop(self):
+        self.task.cancel()
+        self.retire_all()
+
+    def wanted(self) -> int:
+        return self.server.options.warm_tunnels - len(self.pending) - len(self.ready)
+
+    def wake(self):
+        self.changed.set()
+
+    async def maintain(self):
+        while True:
+            await self.fill()
+            await self.changed.wait()
+            self.changed.clear()
+
+    async def fill(self):
+        # warm_tunnels lowered
+        while self.wanted() < 0 and self.ready:
+            relay, timer = self.ready.popitem(last=False)
+            timer.cancel()
+            relay.retire()
+        while self.wanted() > 0:
+            manager_protocol = self.pool.broadcaster.manager_protocol
+            if manager_protocol is None or manager_protocol.multiplex:
+                return
+            # behind the connections of the mapping itself
+            relay = await self.pool.acquire(self.server.options.priority - 1, account=False)
+            if self.wanted() <= 0 or not relay.warm_capable:
+                self.pool.put_nowait(relay)
+                return
+            self.pending.add(relay)
+            relay.warm_up(self)
+
+    def on_ready(self, relay):
+        if relay not in self.pending:
+            return
+        self.pending.discard(relay)
+        self.ready[relay] = asyncio.get_event_loop().call_later(Settings.warm_tunnel_max_age, self.expire, relay)
+
+    def take(self):
+        # the most recently opened local connection is the least likely to have been closed meanwhile
+        if not self.ready:
+            return None
+        relay, timer = self.ready.popitem()
+        timer.cancel()
+        self.server.stats.warm_hits += 1
+        self.wake()
+        return relay
+
+    def discard(self, relay):
+        # the relay or its local connection went away
+        self.pending.discard(relay)
+        timer = self.ready.pop(relay, None)
+        if timer:
+            timer.cancel()
+        self.wake()
+
+    def expire(self, relay):
+        # local services often close connections idle for long, replace the local connection before that
+        del self.ready[relay]
+        self.server.stats.warm_refreshes += 1
+        relay.retire()
+        self.wake()
+
+    def retire_all(self):
+        for relay in list(self.pending) + list(self.ready):
+            self.discard(relay)
+            relay.retire()
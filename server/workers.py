@@ -0,0 +1,349 @@
+import json
+import socket
+import asyncio
+import multiprocessing
+from functools import partial
+from typing import Optional, Dict, Any, List
+
+from loguru import logger
+
+from settings import Settings
+from py_types import TypeEndpoint
+from broadcaster import BroadCaster, Event
+from mapping import MappingOptions, MappingStats
+from server.relay_server import RelayServer
+from server.proxy_server import ProxyServerFactory, ProxyServer
+from server.agents import AgentLoad
+from server.tenants import TenantRegistry, DEFAULT_TENANT, build_tenant
+from utils.event_loop import install_event_loop
+
+
+class WorkerChannel(object):
+    # newline delimited json messages between the control process and a worker process
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    def send(self, message_type: str, **payload):
+        if self.writer.is_closing():
+            return
+        self.writer.write(json.dumps({'type': message_type, **payload}).encode() + b'\n')
+
+    async def serve(self, handler):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                break
+            handler(json.loads(line))
+
+    def close(self):
+        self.writer.close()
+
+
+def settings_snapshot() -> Dict[str, Any]:
+    # spawned workers import settings afresh, hand over what the control process runs with
+    return {k: v for k, v in vars(Settings).items() if not k.startswith('_') and not callable(v)}
+
+
+def check_worker_ports():
+    # worker i serves relays on relay_port + i, none of these ports may be another listener's
+    relay_ports = range(Settings.relay_port, Settings.relay_port + Settings.server_workers)
+    taken = [port for port in (Settings.manager_port, Settings.http_command_port) if port in relay_ports]
+    if taken:
+        raise RuntimeError(f'worker relay ports {relay_ports[0]}-{relay_ports[-1]} overlap port '
+                           f'{", ".join(map(str, taken))}, move relay_port or the manager and http command ports')
+
+
+def run_worker(worker_id: int, sock: socket.socket, settings: Dict[str, Any]):
+    for k, v in settings.items():
+        setattr(Settings, k, v)
+    install_event_loop()
+    asyncio.run(Worker(worker_id).run(sock))
+
+
+class RemoteManager(object):
+    # stands in for the ManagerProtocol of the control process inside a worker
+    def __init__(self, channel: WorkerChannel, session_id: str, multiplex: bool):
+        self.channel = channel
+        self.session_id = session_id
+        self.multiplex = multiplex
+        self.tenant_id = DEFAULT_TENANT
+        # tunnels and traffic of the agent's relays in this worker
+        self.load = AgentLoad()
+
+    def sample_load(self, elapsed: float):
+        self.load.sample(elapsed)
+
+    def apply_new_replier(self, num=1):
+        self.channel.send('new_replier', num=num, session_id=self.session_id)
+
+
+class Worker(object):
+    def __init__(self, worker_id: int):
+        self.worker_id = worker_id
+        self.channel: Optional[WorkerChannel] = None
+        # workers serve the default tenant only
+        self.tenants = TenantRegistry(build_tenant)
+        tenant = self.tenants.get(DEFAULT_TENANT)
+        self.broadcaster = tenant.broadcaster
+        self.pool = tenant.pool
+        self.proxy_server_factory = tenant.proxy_server_factory
+        self.relay_server = RelayServer(self.tenants, Settings.relay_port + worker_id)
+
+    async def run(self, sock: socket.socket):
+        reader, writer = await asyncio.open_connection(sock=sock)
+        self.channel = WorkerChannel(reader, writer)
+        await self.relay_server.start()
+        report = asyncio.get_event_loop().create_task(self.report())
+        await self.channel.serve(self.on_message)
+        # control process is gone
+        report.cancel()
+
+    def on_message(self, message: Dict[str, Any]):
+        message_type = message['type']
+        manager_protocol = self.broadcaster.manager_protocol
+        if message_type == 'manager_valid':
+            if manager_protocol and not Settings.multi_agent:
+                self.broadcaster.fire(Event.ManagerProtocolClose, manager_protocol)
+            self.broadcaster.fire(
+                Event.ManagerProtocolValid,
+                RemoteManager(self.channel, message['session_id'], message['multiplex'])
+            )
+        elif message_type == 'manager_close':
+            agent = self.broadcaster.agents.get(message['session_id'])
+            if agent:
+                self.broadcaster.fire(Event.ManagerProtocolClose, agent)
+        elif message_type == 'add_mapping':
+            asyncio.get_event_loop().create_task(self.add_mapping(message))
+        elif message_type == 'update_options':
+            server = self.proxy_server_factory.servers.get(tuple(message['endpoint']))
+            if server:
+                self.proxy_server_factory.update_options(server, MappingOptions(**message['options']))
+        elif message_type == 'remove_mapping':
+            asyncio.get_event_loop().create_task(
+                self.proxy_server_factory.close_server(tuple(message['endpoint']))
+            )
+
+    async def add_mapping(self, message: Dict[str, Any]):
+        try:
+            await self.proxy_server_factory.create_server(
+                tuple(message['endpoint']),
+                message['bind_port'],
+                MappingOptions(**message['options']),
+                reuse_port=True
+            )
+        except Exception as e:
+            logger.error(f'Worker<{self.worker_id}> serve {message["endpoint"]} fail: {e}')
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(Settings.worker_stats_interval)
+            self.channel.send(
+                'stats',
+                pool=self.pool.stats(),
+                mappings=[
+                    [endpoint, server.stats.dict()]
+                    for endpoint, server in self.proxy_server_factory.servers.items() if server
+                ],
+                agents=[[agent.session_id, agent.load.dict()] for agent in self.broadcaster.agents.values()]
+            )
+
+
+class WorkerHandle(object):
+    def __init__(self, worker_id: int, process: multiprocessing.Process, channel: WorkerChannel):
+        self.worker_id = worker_id
+        self.process = process
+        self.channel = channel
+        self.relay_port = Settings.relay_port + worker_id
+        self.started = asyncio.get_event_loop().time()
+        self.pool_stats: Dict[str, Any] = {}
+        self.mapping_stats: Dict[TypeEndpoint, Dict[str, int]] = {}
+        self.agent_loads: Dict[str, Dict[str, Any]] = {}
+
+
+class WorkerSupervisor(object):
+    # control process side: spawns the workers, forwards manager events and mapping changes to them and
+    # turns their relay requests into NewReplier commands naming the worker's relay port
+    def __init__(self, broadcaster: BroadCaster):
+        self.broadcaster = broadcaster
+        self.workers: Dict[int, WorkerHandle] = {}
+        self.proxy_server_factory: Optional['WorkerProxyServerFactory'] = None
+        self.closing = False
+        # delay before the last restart of each worker
+        self.restart_delays: Dict[int, float] = {}
+        self.broadcaster.add_watcher(Event.ManagerProtocolValid, self.broadcaster_handle)
+        self.broadcaster.add_watcher(Event.ManagerProtocolClose, self.broadcaster_handle)
+
+    async def start(self):
+        for worker_id in range(Settings.server_workers):
+            await self.start_worker(worker_id)
+
+    async def start_worker(self, worker_id: int):
+        parent_sock, child_sock = socket.socketpair()
+        process = multiprocessing.get_context('spawn').Process(
+            target=run_worker,
+            args=(worker_id, child_sock, settings_snapshot()),
+            daemon=True
+        )
+        process.start()
+        child_sock.close()
+        reader, writer = await asyncio.open_connection(sock=parent_sock)
+        handle = WorkerHandle(worker_id, process, WorkerChannel(reader, writer))
+        self.workers[worker_id] = handle
+        self.replay(handle)
+        asyncio.get_event_loop().create_task(self.serve(handle))
+        logger.info(f'Worker<{worker_id}> started, pid {process.pid}, relay port {handle.relay_port}')
+
+    def replay(self, handle: WorkerHandle):
+        for agent in self.broadcaster.agents.values():
+            handle.channel.send('manager_valid', session_id=agent.session_id, multiplex=agent.multiplex)
+        if self.proxy_server_factory:
+            for server in self.proxy_server_factory.servers.values():
+                if server:
+                    handle.channel.send('add_mapping', **self.proxy_server_factory.mapping_message(server, handle))
+
+    async def serve(self, handle: WorkerHandle):
+        await handle.channel.serve(partial(self.on_message, handle))
+        handle.channel.close()
+        if self.closing:
+            return
+        loop = asyncio.get_event_loop()
+        # the channel ends as the process exits, joining it sets the exit code
+        await loop.run_in_executor(None, handle.process.join, 5)
+        if loop.time() - handle.started > Settings.worker_restart_max:
+            delay = Settings.worker_restart_min
+        else:
+            delay = min(self.restart_delays.get(handle.worker_id, Settings.worker_restart_min / 2) * 2,
+                        Settings.worker_restart_max)
+        self.restart_delays[handle.worker_id] = delay
+        logger.error(f'Worker<{handle.worker_id}> exited with {handle.process.exitcode}, restarting in {delay:.0f}s')
+        await asyncio.sleep(delay)
+        if not self.closing:
+            await self.start_worker(handle.worker_id)
+
+    def broadcast(self, message_type: str, **payload):
+        for handle in self.workers.values():
+            handle.channel.send(message_type, **payload)
+
+    def broadcaster_handle(self, event: Event, payload):
+        if event == Event.ManagerProtocolValid:
+            self.broadcast('manager_valid', session_id=payload.session_id, multiplex=payload.multiplex)
+        elif event == Event.ManagerProtocolClose:
+            self.broadcast('manager_close', session_id=payload.session_id)
+
+    def on_message(self, handle: WorkerHandle, message: Dict[str, Any]):
+        message_type = message['type']
+        if message_type == 'new_replier':
+            agent = self.broadcaster.agents.get(message['session_id'])
+            # a request for a manager session that ended meanwhile is dropped
+            if agent:
+                agent.apply_new_replier(message['num'], relay_port=handle.relay_port)
+        elif message_type == 'stats':
+            handle.pool_stats = message['pool']
+            handle.mapping_stats = {tuple(endpoint): stats for endpoint, stats in message['mappings']}
+            handle.agent_loads = dict(message['agents'])
+            if self.proxy_server_factory:
+                self.proxy_server_factory.merge_stats(self.workers.values())
+            for agent in self.broadcaster.agents.values():
+                agent.merge_load([worker.agent_loads[agent.session_id] for worker in self.workers.values()
+                                  if agent.session_id in worker.agent_loads])
+
+    def stop(self):
+        self.closing = True
+        for handle in self.workers.values():
+            handle.channel.close()
+            handle.process.terminate()
+
+    # the relay pool stats api, over the pools of all workers
+    def qsize(self) -> int:
+        return sum(handle.pool_stats.get('size', 0) for handle in self.workers.values())
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [{'worker': handle.worker_id, **handle.pool_stats} for handle in self.workers.values()]
+
+
+def reserve_port(bind_port: int) -> socket.socket:
+    # bound but never listening: holds the port for the workers' SO_REUSEPORT listeners
+    # without taking connections itself
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(('0.0.0.0', bind_port))
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+class WorkerProxyServerFactory(ProxyServerFactory):
+    # the control process keeps the mapping table, every worker listens on each mapping's port
+    def __init__(self, manager_server, broadcaster: BroadCaster, supervisor: WorkerSupervisor):
+        super().__init__(None, manager_server, broadcaster)
+        self.supervisor = supervisor
+        self.supervisor.proxy_server_factory = self
+        self.reserved_socks: Dict[TypeEndpoint, socket.socket] = {}
+
+    def mapping_message(self, server: ProxyServer, handle: WorkerHandle) -> Dict[str, Any]:
+        return {
+            'endpoint': server.endpoint, 'bind_port': server.bind[1],
+            'options': self.worker_options(server.options, handle)
+        }
+
+    def worker_options(self, options: MappingOptions, handle: WorkerHandle) -> Dict[str, Any]:
+        # every worker takes a share of the mapping's connections, and of its limits
+        return options.share(Settings.server_workers, handle.worker_id).dict()
+
+    def check_options(self, options: MappingOptions):
+        # a worker with a share of 0 connections would serve them unlimited
+        if 0 < options.max_connections < Settings.server_workers:
+            raise ValueError(f'max_connections must be 0 or at least server_workers ({Settings.server_workers})')
+
+    async def create_server(self, endpoint: TypeEndpoint, bind_port: int = 0,
+                            options: Optional[MappingOptions] = None, reuse_port: bool = True) -> Optional[ProxyServer]:
+        if endpoint in self.servers:
+            return
+        if options:
+            self.check_options(options)
+        self.servers.setdefault(endpoint, None)
+        try:
+            sock = reserve_port(bind_port)
+        except Exception as e:
+            del self.servers[endpoint]
+            raise e
+        self.increment_id += 1
+        server = ProxyServer(self.increment_id, endpoint, options)
+        server.bind = sock.getsockname()
+        self.reserved_socks[endpoint] = sock
+        self.servers[endpoint] = server
+        self.servers_by_id[server.server_id] = server
+        for handle in self.supervisor.workers.values():
+            handle.channel.send('add_mapping', **self.mapping_message(server, handle))
+        logger.success(f'New ProxyServer Serving On '
+                       f'{"%s:%s" % server.bind}->{"%s:%s" % endpoint} in {len(self.supervisor.workers)} workers')
+        return server
+
+    def update_options(self, server: ProxyServer, options: MappingOptions):
+        self.check_options(options)
+        super().update_options(server, options)
+        for handle in self.supervisor.workers.values():
+            handle.channel.send('update_options', endpoint=server.endpoint,
+                                options=self.worker_options(options, handle))
+
+    def merge_stats(self, handles):
+        for endpoint, server in self.servers.items():
+            if server:
+                server.stats = MappingStats.merge(
+                    handle.mapping_stats[endpoint] for handle in handles if endpoint in handle.mapping_stats
+                )
+
+    async def close_server(self, endpoint):
+        server = self.servers.get(endpoint)
+        if not server:
+            return
+        del self.servers[endpoint]
+        del self.servers_by_id[server.server_id]
+        self.reserved_socks.pop(endpoint).close()
+        self.supervisor.broadcast('remove_mapping', endpoint=endpoint)
+        logger.success(f'ProxyServer Close Done '
+                       f'{"%s:%s" % server.bind}->{"%s:%s" % endpoint}')
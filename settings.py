@@ -6,18 +6,110 @@ class Settings(BaseConfig):
     # command http web settings
     http_command_host = '127.0.0.1'
     http_command_port = 9001
+    watch_interval = 1  # seconds between two snapshots of the watch websocket
 
     # relay settings
     relay_host = remote_host
     relay_port = 81
 
+    # >1 runs proxy and relay listeners in that many worker processes, worker i serves relays on relay_port + i:
+    # relay_port to relay_port + server_workers - 1 must not include manager_port or http_command_port.
+    # mapping rate limits are split evenly between the workers, a single connection gets rate / server_workers;
+    # max_connections and warm_tunnels are split exactly, max_connections must then be 0 or >= server_workers
+    server_workers = 1
+    worker_stats_interval = 1  # seconds between worker stats reports to the control process
+    # a crashed worker is restarted after worker_restart_min seconds, doubled for each crash up to worker_restart_max;
+    # a worker that ran longer than worker_restart_max starts over from worker_restart_min
+    worker_restart_min = 1
+    worker_restart_max = 60
+
     # manager server settings
     manager_host = remote_host
     manager_port = 82
-    idle_replier_num = 5
+    idle_replier_num = 5  # minimum idle relays kept in the pool
+    # while no client agent is connected, accepted connections wait this many seconds for one with reading paused,
+    # at most reconnect_park_max per mapping, more are refused. 0 refuses them all
+    reconnect_grace = 10
+    reconnect_park_max = 100
+
+    # several client agents serve the mappings together: a new client joins the connected ones instead of kicking
+    # them out, unless it reconnects with the agent id of one of them. New tunnels go to the least loaded agent,
+    # load = active tunnels + throughput / agent_load_bytes + manager connection rtt / agent_load_rtt
+    multi_agent = False
+    agent_load_bytes = 1024 * 1024  # bytes/s of relay traffic weighing as much as one active tunnel
+    agent_load_rtt = 0.01  # seconds of rtt weighing as much as one active tunnel
+    agent_id = ''  # client side: the id this agent registers with, hostname:pid when empty
+
+    # adaptive pool sizing: headroom follows the observed acquire rate and relay setup latency
+    relay_pool_max = 200
+    relay_pool_tick = 1  # seconds between rate samples
+    relay_pool_wait_target = 0.005  # seconds of average acquire wait before headroom is doubled
+    relay_request_timeout = 10  # seconds before a requested relay that never arrived is forgotten
+    relay_priority_aging = 0.5  # seconds a connection waits for a relay that count as one priority class
+
+    # dedicated relays go back to the pool after their tunnel closes
+    relay_reuse = True
+    relay_max_reuse = 100  # tunnels per relay before it is closed, 0 for no limit
+    relay_idle_timeout = 60  # seconds an idle relay above the pool target is kept
+    # after NewTunnel a dedicated relay carries the tunnel's bytes unframed, copied straight between the
+    # transports. Such a relay closes with its tunnel instead of going back to the pool, compressed and warm
+    # tunnels stay framed
+    relay_raw = False
+    # linux, python 3.10+: once nothing of a raw tunnel is buffered in python, its bytes are moved between the two
+    # sockets in the kernel with os.splice. Not for mappings with rate limits, setting one moves spliced connections
+    # back to python
+    relay_splice = True
+    splice_chunk = 64 * 1024  # bytes moved per splice call, the default pipe capacity
+    warm_tunnel_max_age = 30  # seconds a warm tunnel waits for a connection before it is replaced by a fresh one
+
+    # event loop of the server, its workers and the client: 'asyncio', 'uvloop' or 'auto' (uvloop when installed)
+    event_loop = 'auto'
+
+    # per connection parser buffer the event loop reads into
+    read_buffer_size = 64 * 1024
+
+    # transport write buffer water marks, crossing them pauses/resumes reading on the other side of the tunnel
+    write_buffer_high = 256 * 1024
+    write_buffer_low = 64 * 1024
+
+    # small-write coalescing of Forward frames, default for new mappings
+    forward_coalesce = False
+    forward_coalesce_delay = 200  # microseconds a partial frame waits for more writes, timers are in ms: asyncio rounds up, uvloop to nearest
+    forward_coalesce_bytes = 16 * 1024  # a frame is sent as soon as this many bytes are pending
+
+    # per-mapping compression of Forward bodies, default codec for new mappings, e.g. 'zlib'
+    compression = None
+    compression_level = 1
+    compression_min_bytes = 128  # smaller chunks gain nothing from compression and are sent as is
+    compression_sample_bytes = 64 * 1024  # raw bytes between two compression ratio checks
+    compression_min_ratio = 0.9  # compressed/raw above this sends the next bytes uncompressed
+    compression_bypass_bytes = 1024 * 1024  # bytes sent uncompressed before compression is tried again
+    compression_offload_bytes = 64 * 1024  # chunks this large are compressed in a worker thread
+
+    # multiplexed relay mode: many tunnels share a few long-lived relay connections
+    relay_multiplex = False
+    multiplex_relay_num = 2
+    multiplex_max_streams = 256
+    multiplex_window = 256 * 1024  # per stream flow-control window in bytes
+
+    # client side: manager reconnect delays grow exponentially from retry_min to retry_max, each drawn at random
+    # below that bound; relay connections the server asks for are opened relay_dial_concurrency at a time
+    manager_retry_min = 0.5
+    manager_retry_max = 30
+    relay_dial_concurrency = 32
+    relay_dial_timeout = 5  # seconds before a relay or manager connection attempt is given up
+
+    # seconds between the client's metric reports over the manager connection, 0 for none
+    client_metrics_interval = 5
 
     # internal setting
     internal_endpoints = [
     ]
     auth_timeout = 2
     auth_token = 'AuthToken'
+    # multi-tenant server: auth token -> tenant id, every tenant (a site behind NAT) has its own agents, relay pool
+    # and mappings. Empty: auth_token is the only token, of the tenant 'default'
+    tenants = {}
+
+    # wire format offered at AuthRequire: 'binary' or 'text'
+    framing = 'binary'
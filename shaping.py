@@ -0,0 +1,35 @@
+import asyncio
+
+
+class TokenBucket(object):
+    # bandwidth limit shared by the connections of a mapping: bytes that already arrived are always taken,
+    # the bucket goes into debt and the caller stops reading until it is paid back
+    def __init__(self, rate: int = 0, burst: int = 0):
+        # rate in bytes per second, 0 for no limit; burst defaults to one second worth of rate
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = float(self.burst)
+        self.last = asyncio.get_event_loop().time()
+
+    def configure(self, rate: int, burst: int = 0):
+        # a changed limit keeps the current debt, so a running transfer cannot skip it
+        self.refill()
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = min(self.tokens, self.burst)
+
+    def refill(self):
+        now = asyncio.get_event_loop().time()
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def consume(self, size: int) -> float:
+        # seconds to wait before reading more, 0 while within the limit
+        if not self.rate:
+            return 0
+        self.refill()
+        self.tokens -= size
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
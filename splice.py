@@ -0,0 +1,160 @@
+import os
+import asyncio
+from typing import Optional, Callable, List
+
+from loguru import logger
+
+from settings import Settings
+
+# os.splice is linux only and came with python 3.10, raw tunnels keep going through python without it
+SPLICE_AVAILABLE = hasattr(os, 'splice')
+SPLICE_FLAGS = getattr(os, 'SPLICE_F_MOVE', 0) | getattr(os, 'SPLICE_F_NONBLOCK', 0)
+
+
+class SplicePump(object):
+    # one direction: what is readable on src goes to dst through a pipe, the bytes never enter python
+    def __init__(self, forwarder: 'SpliceForwarder', src: int, dst: int, on_bytes: Optional[Callable[[int], None]]):
+        self.forwarder = forwarder
+        self.loop = forwarder.loop
+        self.src = src
+        self.dst = dst
+        self.on_bytes = on_bytes
+        self.pipe_r, self.pipe_w = os.pipe()
+        self.pending = 0  # bytes in the pipe dst did not take yet
+
+    def start(self):
+        self.loop.add_reader(self.src, self.on_readable)
+
+    def on_readable(self):
+        try:
+            size = os.splice(self.src, self.pipe_w, Settings.splice_chunk, flags=SPLICE_FLAGS)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.forwarder.close(e)
+            return
+        if not size:
+            self.forwarder.on_eof()
+            return
+        self.pending += size
+        if self.on_bytes:
+            self.on_bytes(size)
+        if not self.flush() and not self.forwarder.closed:
+            # dst is backed up, src is read again once the pipe is empty
+            self.loop.remove_reader(self.src)
+            self.loop.add_writer(self.dst, self.on_writable)
+
+    def on_writable(self):
+        if not self.flush():
+            return
+        self.loop.remove_writer(self.dst)
+        if self.forwarder.ending:
+            self.forwarder.on_eof()
+        elif self.forwarder.on_fall_back:
+            self.forwarder.check_fall_back()
+        else:
+            self.loop.add_reader(self.src, self.on_readable)
+
+    def flush(self) -> bool:
+        try:
+            while self.pending:
+                self.pending -= os.splice(self.pipe_r, self.dst, self.pending, flags=SPLICE_FLAGS)
+        except BlockingIOError:
+            return False
+        except OSError as e:
+            self.forwarder.close(e)
+            return False
+        return True
+
+    def stop(self):
+        self.loop.remove_reader(self.src)
+        self.loop.remove_writer(self.dst)
+        os.close(self.pipe_r)
+        os.close(self.pipe_w)
+
+
+class SpliceForwarder(object):
+    # both directions of a raw tunnel between two sockets, moved by the kernel. The transports of the sockets
+    # stop reading meanwhile and must have nothing left to write, the forwarder works on duplicates of their fds
+    # since the event loop refuses callbacks on a transport's own fd
+    def __init__(self, a: asyncio.Transport, b: asyncio.Transport, on_a_bytes: Optional[Callable[[int], None]] = None,
+                 on_b_bytes: Optional[Callable[[int], None]] = None):
+        self.loop = asyncio.get_event_loop()
+        self.transports = (a, b)
+        self.fds: List[int] = []
+        self.pumps: List[SplicePump] = []
+        # one side ended, the tunnel closes once the other direction's pipe is empty
+        self.ending = False
+        self.closed = False
+        # set while falling back to the python path, called once the pipes are empty
+        self.on_fall_back: Optional[Callable[[], None]] = None
+        try:
+            self.fds = [os.dup(t.get_extra_info('socket').fileno()) for t in self.transports]
+            self.pumps.append(SplicePump(self, self.fds[0], self.fds[1], on_a_bytes))
+            self.pumps.append(SplicePump(self, self.fds[1], self.fds[0], on_b_bytes))
+        except OSError:
+            self.stop()
+            raise
+
+    def start(self):
+        for transport in self.transports:
+            transport.pause_reading()
+        for pump in self.pumps:
+            pump.start()
+
+    def on_eof(self):
+        # an end closes the whole tunnel like on the python path, nothing more is read
+        self.ending = True
+        for pump in self.pumps:
+            self.loop.remove_reader(pump.src)
+        if all(pump.pending == 0 for pump in self.pumps):
+            self.close(None)
+
+    def fall_back(self, on_done: Callable[[], None]):
+        # nothing more is spliced, what is in the pipes still goes out before the transports read again
+        self.on_fall_back = on_done
+        for pump in self.pumps:
+            self.loop.remove_reader(pump.src)
+        self.check_fall_back()
+
+    def check_fall_back(self):
+        if self.closed or any(pump.pending for pump in self.pumps):
+            return
+        on_done, self.on_fall_back = self.on_fall_back, None
+        self.stop()
+        for transport in self.transports:
+            transport.resume_reading()
+        on_done()
+
+    def close(self, exc: Optional[Exception]):
+        if self.closed:
+            return
+        if exc:
+            logger.debug(f'splice stopped: {exc!r}')
+        self.stop()
+        for transport in self.transports:
+            transport.close()
+
+    def stop(self):
+        # before the transports close their sockets, the duplicates would keep the connections open
+        if self.closed:
+            return
+        self.closed = True
+        for pump in self.pumps:
+            pump.stop()
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+
+
+def start_splice(tunnel, a: asyncio.Transport, b: asyncio.Transport,
+                 on_a_bytes: Optional[Callable[[int], None]] = None,
+                 on_b_bytes: Optional[Callable[[int], None]] = None) -> bool:
+    # a and b are the transports of the tunnel's ends, false keeps the tunnel on the python path
+    try:
+        tunnel.splice = SpliceForwarder(a, b, on_a_bytes, on_b_bytes)
+    except OSError as e:
+        logger.debug(f'splice unavailable: {e!r}')
+        return False
+    tunnel.splice.start()
+    return True
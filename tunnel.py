@@ -1,10 +1,13 @@
-from typing import Optional
+import asyncio
+from typing import Optional, Callable, List
 
 from py_types import TypeEndpoint
+from mapping import MappingOptions, MappingStats
 
 
 class Tunnel(object):
-    def __init__(self, server: 'TunnelPoint', client: 'TunnelPoint', endpoint: Optional[TypeEndpoint] = None):
+    def __init__(self, server: 'TunnelPoint', client: 'TunnelPoint', endpoint: Optional[TypeEndpoint] = None,
+                 options: Optional[MappingOptions] = None, stats: Optional[MappingStats] = None):
         self.server = server
         self.client = client
         self.pair = {
@@ -13,6 +16,10 @@ class Tunnel(object):
         }
         self.connected = True
         self.endpoint = endpoint
+        self.options = options or MappingOptions()
+        self.stats = stats or MappingStats()
+        # SpliceForwarder moving the bytes of a raw tunnel in the kernel
+        self.splice = None
 
     def build(self):
         self.server.on_tunnel_build(self)
@@ -24,10 +31,23 @@ class Tunnel(object):
         receiver = self.pair[sender]
         receiver.on_tunnel_write(data)
 
+    def pause(self, sender):
+        # sender cannot take more data for now, stop the other side from reading
+        if not self.connected:
+            return
+        self.pair[sender].on_tunnel_pause()
+
+    def resume(self, sender):
+        if not self.connected:
+            return
+        self.pair[sender].on_tunnel_resume()
+
     def close(self, sender, exc: Optional[Exception] = None):
         if not self.connected:
             return
         self.connected = False
+        if self.splice:
+            self.splice.stop()
         receiver = self.pair[sender]
         receiver.on_tunnel_close(exc)
         self.pair = {}
@@ -37,6 +57,7 @@ class FakeCloseTunnel(Tunnel):
 
     def __init__(self):
         self.connected = False
+        self.splice = None
 
     def build(self):
         raise RuntimeError('fake close tunnel just support close')
@@ -44,6 +65,12 @@ class FakeCloseTunnel(Tunnel):
     def write(self, sender, data: bytes):
         raise RuntimeError('fake close tunnel just support close')
 
+    def pause(self, sender):
+        pass
+
+    def resume(self, sender):
+        pass
+
     def close(self, sender, exc: Optional[Exception] = None):
         pass
 
@@ -59,3 +86,52 @@ class TunnelPoint(object):
 
     def on_tunnel_write(self, data: bytes):
         pass
+
+    def on_tunnel_pause(self):
+        pass
+
+    def on_tunnel_resume(self):
+        pass
+
+
+class ForwardCoalescer(object):
+    # merges tunnel writes arriving within options.coalesce_delay microseconds into one Forward body
+    def __init__(self, emit: Callable[[bytes], None], options: MappingOptions, stats: MappingStats):
+        self.emit = emit
+        self.options = options
+        self.stats = stats
+        self.buffers: List[bytes] = []
+        self.size = 0
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    def write(self, data: bytes):
+        self.stats.forward_writes += 1
+        if not self.options.coalesce:
+            self.stats.forward_frames += 1
+            self.emit(data)
+            return
+        self.buffers.append(data)
+        self.size += len(data)
+        if self.size >= self.options.coalesce_bytes:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_event_loop().call_later(self.options.coalesce_delay / 1e6, self.flush)
+
+    def flush(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if not self.buffers:
+            return
+        data = self.buffers[0] if len(self.buffers) == 1 else b''.join(self.buffers)
+        self.buffers = []
+        self.size = 0
+        self.stats.forward_frames += 1
+        self.emit(data)
+
+    def discard(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        self.buffers = []
+        self.size = 0
@@ -0,0 +1,25 @@
+import asyncio
+from typing import Optional
+
+from loguru import logger
+
+from settings import Settings
+
+EVENT_LOOPS = ('auto', 'asyncio', 'uvloop')
+
+
+def install_event_loop(name: Optional[str] = None) -> str:
+    # sets the event loop policy of this process before any loop is created, returns the loop in use
+    name = name or Settings.event_loop
+    if name not in EVENT_LOOPS:
+        raise ValueError(f'unknown event loop {name}, available: {", ".join(EVENT_LOOPS)}')
+    if name == 'asyncio':
+        return 'asyncio'
+    try:
+        import uvloop
+    except ImportError:
+        if name == 'uvloop':
+            logger.warning('uvloop is not installed, falling back to the asyncio event loop')
+        return 'asyncio'
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return 'uvloop'
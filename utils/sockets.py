@@ -1,4 +1,5 @@
 import socket
+import struct
 from typing import Optional, Union
 import asyncio
 
@@ -57,3 +58,15 @@ def set_socket_keepalive(sock: socket.socket,
     sock.setsockopt(socket.SOL_TCP, socket.TCP_KEEPCNT, tcp_keepcnt)  # max retries
 
 
+
+
+def get_tcp_rtt(sock: socket.socket) -> Optional[float]:
+    # smoothed round trip time in seconds the kernel keeps for the connection, linux only
+    if not hasattr(socket, 'TCP_INFO'):
+        return None
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 104)
+    except OSError:
+        return None
+    # struct tcp_info: 8 single byte fields, then 32 bit fields of which tcpi_rtt (microseconds) is the 16th
+    return struct.unpack_from('I', info, 68)[0] / 1e6